@@ -7,6 +7,10 @@ Process:
 Put text into duplicate files named "raw" and "clean"
 > pdftotext x.pdf raw
 Clean up obvious problems in clean:
+ test.py lint
+ lists everything below that a script can spot, with line numbers,
+ in one pass: odd characters, smart quotes, isolated letters, digits
+ in words, 1's that may be I's and hyphenated line endings
 * Remove line numbers, headers, and footers
 * Look for odd characters and make sure they are supposed to be there
 * Replace smart apostrophe's with dumb ones
@@ -28,6 +32,10 @@ Save first ~300 lines to file named "test"
 Add paragraph tags to new book.html
  test.py add -max (number from above)
 
+Or skip the test file and let the line lengths of the whole text pick
+the paragraph breaks (needs NumPy)
+ test.py auto
+
 
 Put this at the head of book.html. Update TITLE and AUTHOR
 ---
@@ -57,14 +65,37 @@ Start adding missed paragraph tags and removing wrongly-added tags
 ** If line in firsts not a break, remove <p> tag from book.html and remove line from firsts
 ** If section break, add new line to firsts with nbsp
 * Periodically run test.py check to make sure everything is in sync
+** Or leave test.py watch running, which prints the counts every time firsts or book.html is saved
 * When bored run test.py update followed by test.py verify to move changes into book.html. Revove all executed lines from firsts
+** book.html is only replaced once the update is written, and -backups N keeps the last N versions as book.html.1 and up
+* Or run several steps in one go, reading each file once and writing at the end:
+ test.py pipeline update firsts verify
 
 Fix up hyphenated words, add ellipses, re-run aspell, etc
 """
+from __future__ import print_function
 
 from argparse import ArgumentParser
+from array import array
+import bisect
+import codecs
 from collections import Counter
+import io
 import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+# Python 2 lacks the first two, and its input evaluates what is typed;
+# rename replaces the target on posix as well
+replace_file = getattr(os, "replace", os.rename)
+perf_counter = getattr(time, "perf_counter", time.time)
+try:
+    input = raw_input
+except NameError:
+    pass
 
 CAPITALS = (
     "A",
@@ -95,6 +126,29 @@ CAPITALS = (
     "Z",
 )
 
+# the characters the egrep below would list, less smart quotes
+# (reported on their own). Unicode strings rather than raw ones, as
+# Python 2's re has no \u escapes, and re.UNICODE so that \w there
+# takes in accented letters as it does on Python 3
+ODD_CHARACTER = re.compile(u"[^a-zA-Z0-9.,?;:()'\" \u2018\u2019\u201c\u201d-]")
+SMART_QUOTE = re.compile(u"[\u2018\u2019\u201c\u201d]")
+ISOLATED_LETTER = re.compile(
+    u"(?<![\\w'\u2019])[B-HJ-Zb-z](?![\\w'\u2019])", re.UNICODE
+)
+DIGIT_IN_WORD = re.compile(r"\b(?=[a-zA-Z]*\d)(?=\d*[a-zA-Z])\w+\b", re.UNICODE)
+LONE_ONE = re.compile(r"(?<![\w.,])1(?![\w.,])", re.UNICODE)
+HYPHEN_END = re.compile(r"[a-zA-Z]-$")
+TAG = re.compile("<[^>]+>")
+# line numbers listed for each odd character
+ODD_EXAMPLES = 5
+# for the auto paragraph breaks
+SENTENCE_END = re.compile(u"[.?!:]['\")\u2019\u201d]*$")
+STARTS_WITH_CAP = re.compile(u"['\"\u2018\u201c]*[A-Z]")
+# how many spreads of the full line lengths short of their median a
+# line has to be to end a paragraph, and the least it can be short by
+SHORT_SPREADS = 3
+SHORT_LEAST = 3
+
 
 class Line:
     """ Holds data about line."""
@@ -113,62 +167,195 @@ class Line:
         return self.text
 
 
-def find_max_length():
+def find_max_length(lines=None):
     """ Determine max length of guessed new paragraph"""
+    if lines is None:
+        lines = read_lines("test")
     lengths = Counter()
     last_line = None
-    with open("test") as f:
-        for l in f:
-            if "<p" in l:
-                last_line = None
-                continue
-            if last_line:
-                lengths[len(last_line)] += 1
-            last_line = l.strip()
+    for l in lines:
+        if "<p" in l:
+            last_line = None
+            continue
+        if last_line:
+            lengths[len(last_line)] += 1
+        last_line = l
     for idx, k in enumerate(lengths):
         if idx > 5:
             break
         print(k, lengths[k])
 
 
-def add_lines(max_length):
+def read_lines(path):
+    """ Yields the stripped lines of the file at path, one at a time."""
+    with io.open(path, encoding="utf-8") as f:
+        for l in f:
+            yield l.strip()
+
+
+def rewrite(path, lines, backups=0):
+    """ Writes lines to a temp file next to path, then renames it over
+    path, so a crash part way leaves the old file whole. lines can be
+    read from path itself, as it is only replaced at the end.
+    With backups, the old file is kept as path.1, and older copies
+    move up to path.2 and so on, keeping that many."""
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=directory, suffix=".tmp", delete=False
+    ) as f:
+        try:
+            for line in lines:
+                f.write(line.encode("utf-8"))
+                f.write(b"\n")
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    # temp files are private, the file they replace usually is not
+    if os.path.exists(path):
+        shutil.copymode(path, f.name)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(f.name, 0o666 & ~umask)
+    if backups and os.path.exists(path):
+        for idx in range(backups - 1, 0, -1):
+            older = "{}.{}".format(path, idx)
+            if os.path.exists(older):
+                replace_file(older, "{}.{}".format(path, idx + 1))
+        shutil.copy2(path, path + ".1")
+    replace_file(f.name, path)
+
+
+def guessed_lines(lines, max_length):
+    """ Yields the lines with a paragraph tag before each one that
+    starts with a capital after a short line."""
+    last = ""
+    yield last
+    for line in lines:
+        if not line:
+            continue
+        if "<h2>" not in line:
+            if len(last) < max_length and line[0] in CAPITALS:
+                yield "<p>"
+        yield line
+        last = line
+
+
+def add_lines(max_length, backups=0):
     """ Put guessed paragraph lines in file."""
     if os.path.exists("book.html"):
         answer = input("book.html exists. Overwrite? ")
         if not answer.lower().startswith("y"):
             return
-    lines = [""]
-    with open("clean") as f:
-        for l in f:
-            line = l.strip()
-            if not line:
-                continue
-            if "<h2>" in line:
-                lines.append(line)
-            else:
-                if len(lines[-1]) < max_length and line[0] in CAPITALS:
-                    lines.append("<p>")
-                lines.append(line)
-    with open("book.html", "w") as f:
-        for l in lines:
-            f.write("{}\n".format(l))
+    rewrite("book.html", guessed_lines(read_lines("clean"), max_length), backups)
+
+
+def line_features(lines):
+    """ Arrays with an entry per non-blank line: its length, the length
+    of its first word and whether it ends a sentence, starts with a
+    capital (after any opening quotes) and is a chapter heading."""
+    lengths = array("i")
+    first_words = array("i")
+    ends = array("b")
+    capitals = array("b")
+    headings = array("b")
+    for line in lines:
+        if not line:
+            continue
+        heading = "<h2>" in line
+        lengths.append(len(line))
+        first_words.append(len(line.split(None, 1)[0]))
+        ends.append(heading or SENTENCE_END.search(line) is not None)
+        capitals.append(STARTS_WITH_CAP.match(line) is not None)
+        headings.append(heading)
+    return lengths, first_words, ends, capitals, headings
+
+
+def auto_breaks(lengths, first_words, ends, capitals, headings):
+    """ Decides which lines start a paragraph, without a -max.
+
+    Most lines of a page run the full width, so the median length of
+    the text lines is a full line, and the median distance from it is
+    how much full lines vary. A line more than SHORT_SPREADS of those
+    (and at least SHORT_LEAST characters) short of the median is taken
+    to end a paragraph, and so is a line that had room left for the
+    first word of the next one, going by the longest lines.
+    A line starts a paragraph if it begins with a capital and follows
+    a line like that which ends a sentence, or a heading.
+    Returns the length a line must be under to be short, and an array
+    of whether each line starts a paragraph.
+    """
+    import numpy as np
+
+    length = np.frombuffer(lengths, dtype=np.intc)
+    first_word = np.frombuffer(first_words, dtype=np.intc)
+    heading = np.frombuffer(headings, dtype=np.int8).astype(bool)
+    ends = np.frombuffer(ends, dtype=np.int8).astype(bool)
+    capital = np.frombuffer(capitals, dtype=np.int8).astype(bool)
+    text = length[~heading]
+    if not text.size:
+        return 0, np.zeros(length.size, dtype=bool)
+    median = np.median(text)
+    spread = np.median(np.abs(text - median))
+    threshold = int(median - max(SHORT_SPREADS * spread, SHORT_LEAST))
+    width = np.percentile(text, 99)
+    # the start of the text counts as coming after a short, ended line
+    short = np.concatenate(([True], length[:-1] < threshold))
+    short[1:] |= length[:-1] + 1 + first_word[1:] <= width
+    ended = np.concatenate(([True], ends[:-1]))
+    after_heading = np.concatenate(([False], heading[:-1]))
+    starts = ~heading & capital & ((short & ended) | after_heading)
+    return threshold, starts
+
+
+def marked_lines(lines, starts):
+    """ Yields the non-blank lines, after an empty line as add starts
+    with, with a paragraph tag before each one marked in starts."""
+    yield ""
+    idx = 0
+    for line in lines:
+        if not line:
+            continue
+        if starts[idx]:
+            yield "<p>"
+        yield line
+        idx += 1
+
+
+def add_auto(backups=0):
+    """ Put paragraph lines in file, finding the breaks from the
+    statistics of the whole text instead of a -max."""
+    if os.path.exists("book.html"):
+        answer = input("book.html exists. Overwrite? ")
+        if not answer.lower().startswith("y"):
+            return
+    threshold, starts = auto_breaks(*line_features(read_lines("clean")))
+    print("short lines are under {}, {} paragraphs".format(threshold, starts.sum()))
+    rewrite("book.html", marked_lines(read_lines("clean"), starts), backups)
+
+
+def paragraph_starts(lines):
+    """ Yields the first line of each paragraph."""
+    is_first = False
+    for l in lines:
+        if is_first:
+            if "<p" not in l and "<h2>" not in l:
+                yield l
+        is_first = "<p" in l
+
+
+def first_lines(starts):
+    """ Yields the lines of a new firsts file, all marked as found."""
+    for first in starts:
+        yield u"   {}".format(first[:50])
 
 
 def first_words(update):
     """ Writes out the first words of paragraphs."""
-    is_first = False
-    firsts = []
-    with open("book.html") as f:
-        for l in f:
-            if is_first:
-                if "<p" not in l and "<h2>" not in l:
-                    firsts.append(l.strip())
-            is_first = "<p" in l
+    firsts = list(paragraph_starts(read_lines("book.html")))
     if update:
-        with open("firsts", "w") as f:
-            for first in firsts:
-                writable = first if len(first) < 50 else first[:50]
-                f.write("   {}\n".format(writable))
+        rewrite("firsts", first_lines(firsts))
     return firsts
 
 
@@ -183,111 +370,462 @@ class First:
         """ Whether already marked with paragraph"""
         return self.line.startswith("   ")
 
+    @property
+    def nbsp(self):
+        """ Whether the line marks a section break."""
+        return self.line.strip() == "nbsp"
+
+    @property
+    def text(self):
+        """ What a line in the text starts with if it matches."""
+        if self.found:
+            return self.line[3:]
+        return self.line
+
     def matches(self, line):
         """ Whether line in text matches the first."""
-        if self.found:
-            return line.startswith(self.line[3:])
-        return line.startswith(self.line)
+        return line.startswith(self.text)
+
+
+class Firsts:
+    """ The lines of the firsts file, for matching the book against.
+
+    The firsts are in the order of the book, and the same few words
+    often start many paragraphs, so a line of the book only counts for
+    the first that is due next. Only that one is compared, so each
+    line takes the same time however long the file is.
+    """
+
+    def __init__(self, lines):
+        self.entries = [First(l) for l in lines]
+
+    @staticmethod
+    def read(path="firsts"):
+        """ The firsts in the file at path."""
+        with io.open(path, encoding="utf-8") as f:
+            return Firsts([l.rstrip() for l in f])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def walk(self, lines):
+        """ Goes through lines in step with the firsts.
+        Yields (line, first, breaks) for each line: first is the entry it
+        matches, or None, and breaks how many section breaks come before
+        the entry due next. Sets matched to how many entries were passed.
+        """
+        self.matched = 0
+        breaks = self.skip_breaks()
+        for line in lines:
+            first, passed = self.step(line)
+            yield line, first, breaks
+            if first is not None:
+                breaks = passed
+
+    def step(self, line):
+        """ Matches line against the first due next. Returns the entry
+        it matched, or None, and how many section breaks were passed
+        after it."""
+        if self.matched < len(self.entries):
+            first = self.entries[self.matched]
+            if first.matches(line):
+                self.matched += 1
+                return first, self.skip_breaks()
+        return None, 0
+
+    def skip_breaks(self):
+        """ Passes the section breaks due next, returning how many."""
+        breaks = 0
+        while self.matched < len(self.entries) and self.entries[self.matched].nbsp:
+            breaks += 1
+            self.matched += 1
+        return breaks
+
+
+def lint_lines(lines, odd):
+    """ Yields (line number, problem, text) for what needs a look in the
+    lines, and counts the odd characters into odd, a dict of character
+    to [count, line numbers]. One pass, a line at a time."""
+    for number, line in enumerate(lines, 1):
+        text = TAG.sub("", line)
+        for c in ODD_CHARACTER.findall(text):
+            seen = odd.setdefault(c, [0, []])
+            seen[0] += 1
+            if len(seen[1]) < ODD_EXAMPLES and number not in seen[1]:
+                seen[1].append(number)
+        for quote in SMART_QUOTE.findall(text):
+            yield number, "smart quote", quote
+        for letter in ISOLATED_LETTER.findall(text):
+            yield number, "isolated letter", letter
+        for word in DIGIT_IN_WORD.findall(text):
+            yield number, "digit in word", word
+        if LONE_ONE.search(text):
+            yield number, "1 or I", text
+        if HYPHEN_END.search(text):
+            yield number, "hyphenated end", text
+
+
+def lint(lines=None):
+    """ Prints the problems in clean that the cleanup steps look for."""
+    if lines is None:
+        lines = read_lines("clean")
+    odd = {}
+    for number, problem, text in lint_lines(lines, odd):
+        print(u"{:>6}: {}: {}".format(number, problem, text))
+    for c, (count, numbers) in sorted(odd.items(), key=lambda x: -x[1][0]):
+        print(
+            u"odd character {!r}: {} (lines {})".format(
+                c, count, ", ".join(str(n) for n in numbers)
+            )
+        )
+
+
+def print_check(firsts, lines):
+    """ Prints each first matched in lines, then how many firsts there
+    are and how many were matched."""
+    for _, first, _ in firsts.walk(lines):
+        if first is not None:
+            print(first.line)
+    print(len(firsts))
+    print(firsts.matched)
 
 
 def checked_missed():
     """ Verify firsts file"""
-    lines = []
-    with open("book.html") as f:
-        for l in f:
-            lines.append(l.strip())
-    firsts = []
-    with open("firsts") as f:
-        for l in f:
-            firsts.append(First(l.rstrip()))
-    first_index = 0
-    new_lines = []
-    for line in lines:
-        if len(firsts) > first_index:
-            if firsts[first_index].line == "nbsp":
-                new_lines.append("nbsp")
-                first_index += 1
-            if firsts[first_index].matches(line):
-                new_lines.append(firsts[first_index].line)
-                first_index += 1
-                print(new_lines[-1])
-    print(len(firsts))
-    print(len(new_lines))
+    print_check(Firsts.read(), read_lines("book.html"))
+
+
+def missed_lines(firsts, lines):
+    """ Yields the lines with paragraph tags added for the new firsts
+    and section breaks where the firsts have nbsp."""
+    added_breaks = False
+    for line, first, breaks in firsts.walk(lines):
+        # section breaks go before the paragraph they come before
+        new_paragraph = first is not None and not first.found
+        if breaks and not added_breaks and (line == "<p>" or new_paragraph):
+            for _ in range(breaks):
+                yield "<p>&nbsp;"
+            added_breaks = True
+        if new_paragraph:
+            yield "<p>"
+        if first is not None:
+            added_breaks = False
+        yield line
+
+
+def add_missed(backups=0):
+    """ Add paragraph tags to book.html"""
+    rewrite("book.html", missed_lines(Firsts.read(), read_lines("book.html")), backups)
 
 
-def add_missed():
-    """ Add paragraph tags to book.html"""
-    lines = []
-    with open("book.html") as f:
-        for l in f:
-            lines.append(l.strip())
-    firsts = []
-    with open("firsts") as f:
-        for l in f:
-            firsts.append(First(l.rstrip()))
-    first_index = 0
-    new_lines = []
-    add_nbsp = False
-    for line in lines:
-        if add_nbsp and line == "<p>":
-            new_lines.append("<p>&nbsp;")
-            add_nbsp = False
-
-        if len(firsts) > first_index:
-            if firsts[first_index].line == "nbsp":
-                add_nbsp = True
-                first_index += 1
-            if firsts[first_index].matches(line):
-                if not firsts[first_index].found:
-                    if add_nbsp:
-                        new_lines.append("<p>&nbsp;")
-                        add_nbsp = False
-                    new_lines.append("<p>")
-                first_index += 1
-        new_lines.append(line)
-    with open("book.html", "w") as f:
-        for line in new_lines:
-            f.write(line)
-            f.write("\n")
+def print_verify(firsts, starts):
+    """ Prints how many firsts the paragraph starts match, then how
+    many firsts there are."""
+    for _ in firsts.walk(starts):
+        pass
+    print(firsts.matched)
+    print(len(firsts))
 
 
 def verify_updated():
     """ Makes sure all the lines are there"""
-    firsts = []
-    with open("firsts") as f:
-        for l in f:
-            firsts.append(l.strip())
-    first_index = 0
-    matching_counter = 0
-    start_paras = first_words(False)
-    for start_para in start_paras:
-        if start_para.startswith(firsts[first_index]):
-            matching_counter += 1
-            if first_index + 1 < len(firsts):
-                first_index += 1
-                if firsts[first_index] == "nbsp":
-                    matching_counter += 1
-                    first_index += 1
-    print(matching_counter)
-    print(len(firsts))
+    print_verify(Firsts.read(), paragraph_starts(read_lines("book.html")))
+
+
+def changed_region(old, new):
+    """ Returns (start, old end, new end) of the lines between the
+    common start and the common end of old and new, or None if they
+    are the same. A linear scan from each end, as a save usually
+    changes one stretch of the file."""
+    start = 0
+    shortest = min(len(old), len(new))
+    while start < shortest and old[start] == new[start]:
+        start += 1
+    if start == len(old) == len(new):
+        return None
+    old_end = len(old)
+    new_end = len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    return start, old_end, new_end
+
+
+class CheckState:
+    """ The walk of book.html against the firsts, as check does it,
+    remembering how many firsts had been passed before each line.
+
+    After an edit only the lines from the first change on are walked
+    again, and only until the walk is back in step with the old one
+    past the last change, as the lines after that come out the same.
+    The change is found by trimming the lines the old and new versions
+    start and end with.
+    """
+
+    def __init__(self, firsts_lines, book_lines):
+        self.firsts_lines = firsts_lines
+        self.book = book_lines
+        self.firsts = Firsts(firsts_lines)
+        # passed[i] is how many firsts were passed before line i;
+        # the last entry is how many after the last line
+        self.passed = []
+        self.walked = 0
+        self.resume(0, 0, lambda idx, passed: None)
+
+    @property
+    def matched(self):
+        return self.passed[-1]
+
+    def resume(self, start, matched, converged):
+        """ Walks the book from line start with matched firsts passed,
+        keeping the old passed counts before it. converged(idx, passed)
+        returns the rest of the passed counts once the walk is back in
+        step at line idx, or None."""
+        firsts = self.firsts
+        passed = self.passed[:start]
+        firsts.matched = matched
+        firsts.skip_breaks()
+        self.walked = 0
+        for idx in range(start, len(self.book)):
+            tail = converged(idx, firsts.matched)
+            if tail is not None:
+                self.passed = passed + tail
+                return
+            passed.append(firsts.matched)
+            firsts.step(self.book[idx])
+            self.walked += 1
+        passed.append(firsts.matched)
+        self.passed = passed
+
+    def update_firsts(self, lines):
+        """ Takes the new lines of the firsts file."""
+        change = changed_region(self.firsts_lines, lines)
+        self.firsts_lines = lines
+        self.firsts = Firsts(lines)
+        if change is None:
+            return
+        first_change, old_end, new_end = change
+        shift = new_end - old_end
+        old = self.passed
+        # from the line that reached the change, or the first one
+        start = max(bisect.bisect_left(old, first_change) - 1, 0)
+        matched = old[start] if old[start] < first_change else 0
+
+        def converged(idx, passed):
+            if old[idx] >= old_end and passed == old[idx] + shift:
+                return [p + shift for p in old[idx:]]
+            return None
+
+        self.resume(start, matched, converged)
+
+    def update_book(self, lines):
+        """ Takes the new lines of book.html."""
+        change = changed_region(self.book, lines)
+        self.book = lines
+        if change is None:
+            return
+        start, old_end, new_end = change
+        shift = new_end - old_end
+        old = self.passed
+
+        def converged(idx, passed):
+            if idx >= new_end and passed == old[idx - shift]:
+                return old[idx - shift:]
+            return None
+
+        self.resume(start, old[start], converged)
+
+
+def watch(interval=0.2):
+    """ Prints the check counts whenever firsts or book.html is saved,
+    walking again only what the change can affect. Stops on Ctrl-C."""
+    paths = ("firsts", "book.html")
+
+    def read(path):
+        with io.open(path, encoding="utf-8") as f:
+            if path == "firsts":
+                return [l.rstrip() for l in f]
+            return [l.strip() for l in f]
+
+    def report(state, seconds):
+        line = "{} of {} firsts matched".format(state.matched, len(state.firsts))
+        if state.matched < len(state.firsts):
+            line += u", stuck at: {}".format(state.firsts.entries[state.matched].line)
+        print(u"{} ({} lines walked in {:.1f}ms)".format(line, state.walked, seconds * 1000))
+
+    mtimes = dict((path, os.stat(path).st_mtime) for path in paths)
+    start = perf_counter()
+    state = CheckState(read("firsts"), read("book.html"))
+    report(state, perf_counter() - start)
+    try:
+        while True:
+            time.sleep(interval)
+            for path in paths:
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    # mid-save by an editor that replaces the file
+                    continue
+                if mtime == mtimes[path]:
+                    continue
+                mtimes[path] = mtime
+                lines = read(path)
+                start = perf_counter()
+                if path == "firsts":
+                    state.update_firsts(lines)
+                else:
+                    state.update_book(lines)
+                report(state, perf_counter() - start)
+    except KeyboardInterrupt:
+        pass
+
+
+class Manuscript:
+    """ The test, clean, book.html and firsts files of a book held in
+    memory, so several stages can run one after another in a single
+    process. Each file is read once, when a stage first needs it, and
+    the ones a stage changed are only written by save.
+
+    from raw2ebook import Manuscript
+    book = Manuscript()
+    book.run(["update", "firsts", "verify"])
+    book.save(backups=3)
+    """
+
+    STAGES = ("lint", "test", "add", "auto", "firsts", "check", "update", "verify")
+
+    def __init__(self, directory="."):
+        self.directory = directory
+        self.files = {}
+        self.changed = []
+        self._firsts = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def lines(self, name):
+        """ The lines of the named file, stripped except for the indent
+        that marks found firsts."""
+        if name not in self.files:
+            if name == "firsts":
+                with io.open(self.path(name), encoding="utf-8") as f:
+                    self.files[name] = [l.rstrip() for l in f]
+            else:
+                self.files[name] = list(read_lines(self.path(name)))
+        return self.files[name]
+
+    def replace(self, name, lines):
+        self.files[name] = list(lines)
+        if name not in self.changed:
+            self.changed.append(name)
+        if name == "firsts":
+            self._firsts = None
+
+    @property
+    def firsts(self):
+        if self._firsts is None:
+            self._firsts = Firsts(self.lines("firsts"))
+        return self._firsts
+
+    def lint(self):
+        lint(self.lines("clean"))
+
+    def test(self):
+        find_max_length(self.lines("test"))
+
+    def add(self, max_length):
+        self.replace("book.html", guessed_lines(self.lines("clean"), max_length))
+
+    def auto(self):
+        clean = self.lines("clean")
+        threshold, starts = auto_breaks(*line_features(clean))
+        print("short lines are under {}, {} paragraphs".format(threshold, starts.sum()))
+        self.replace("book.html", marked_lines(clean, starts))
+
+    def first_words(self):
+        self.replace("firsts", first_lines(paragraph_starts(self.lines("book.html"))))
+
+    def check(self):
+        print_check(self.firsts, self.lines("book.html"))
+
+    def update(self):
+        self.replace("book.html", missed_lines(self.firsts, self.lines("book.html")))
+
+    def verify(self):
+        print_verify(self.firsts, paragraph_starts(self.lines("book.html")))
+
+    def run(self, stages, max_length=None):
+        """ Runs the named stages in order."""
+        for stage in stages:
+            if stage not in self.STAGES:
+                raise ValueError("unknown stage {}".format(stage))
+        for stage in stages:
+            if stage == "add":
+                self.add(max_length)
+            elif stage == "firsts":
+                self.first_words()
+            else:
+                getattr(self, stage)()
+
+    def save(self, backups=0):
+        """ Writes the changed files, book.html with backups."""
+        for name in self.changed:
+            rewrite(
+                self.path(name),
+                self.files[name],
+                backups if name == "book.html" else 0,
+            )
+        self.changed = []
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("action")
+    parser.add_argument(
+        "stages",
+        nargs="*",
+        help='for "pipeline", the actions to run in order in one process',
+    )
     parser.add_argument("-max", type=int)
+    parser.add_argument(
+        "-backups",
+        type=int,
+        default=0,
+        help="keep this many old copies of book.html as book.html.1 and up",
+    )
     args = parser.parse_args()
+    if sys.version_info[0] == 2 and sys.stdout.encoding is None:
+        # Python 2 prints unicode as ascii when piped
+        sys.stdout = codecs.getwriter("utf-8")(sys.stdout)
     if args.action == "check":
         checked_missed()
     elif args.action == "update":
-        add_missed()
+        add_missed(args.backups)
     elif args.action == "firsts":
         first_words(True)
     elif args.action == "verify":
         verify_updated()
+    elif args.action == "watch":
+        watch()
+    elif args.action == "lint":
+        lint()
     elif args.action == "test":
         find_max_length()
     elif args.action == "add":
-        add_lines(args.max)
+        add_lines(args.max, args.backups)
+    elif args.action == "auto":
+        add_auto(args.backups)
+    elif args.action == "pipeline":
+        for stage in args.stages:
+            if stage not in Manuscript.STAGES:
+                parser.error("unknown stage {}".format(stage))
+        adds = "add" in args.stages or "auto" in args.stages
+        if adds and os.path.exists("book.html"):
+            answer = input("book.html exists. Overwrite? ")
+            if not answer.lower().startswith("y"):
+                sys.exit(1)
+        book = Manuscript()
+        book.run(args.stages, args.max)
+        book.save(args.backups)
     else:
         print("WRONG")
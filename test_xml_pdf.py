@@ -0,0 +1,141 @@
+""" Tests for xml_pdf, run with python -m unittest test_xml_pdf"""
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import xml_pdf
+
+HEAD = u"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE pdf2xml SYSTEM "pdf2xml.dtd">
+<pdf2xml producer="poppler" version="0.86.1">
+<config top_margin="0" bottom_margin="1100" para_break="30" buf="3" default_font="0" />
+{title}<author>A. Writer</author>
+"""
+PAGE_START = u"""<page number="{number}" position="absolute" top="0" left="0" height="{height}" width="918">
+\t<fontspec id="0" size="12" family="Times" color="#000000"/>
+"""
+TEXT = u"""<text top="{}" left="{}" width="400" height="17" font="0">{}</text>
+"""
+
+
+def layout_xml(pages, title=u"Test Book", bad_page=None):
+    """ pdftohtml style xml of pages, each a list of (top, left, text);
+    bad_page gets a height that is not a number."""
+    parts = [HEAD.format(title=u"<title>{}</title>\n".format(title) if title else u"")]
+    for number, lines in enumerate(pages, 1):
+        height = u"x" if number == bad_page else u"1188"
+        parts.append(PAGE_START.format(number=number, height=height))
+        parts.extend(TEXT.format(*line) for line in lines)
+        parts.append(u"</page>\n")
+    parts.append(u"</pdf2xml>\n")
+    return u"".join(parts)
+
+
+def book_xml(pages=3, title=u"Test Book", bad_page=None):
+    """ A small book of two lines a page."""
+    return layout_xml(
+        [
+            [(100, 50, u"The first line of page {}".format(number)), (121, 50, u"and more.")]
+            for number in range(1, pages + 1)
+        ],
+        title,
+        bad_page,
+    )
+
+
+def indented_pages(pages=6, lines=30):
+    """ Pages of body text with every fifth line indented."""
+    return [
+        [
+            (100 + 21 * idx, 80 if idx % 5 == 0 else 50, u"Line {} of page {}".format(idx, number))
+            for idx in range(lines)
+        ]
+        for number in range(1, pages + 1)
+    ]
+
+
+class BookTest(unittest.TestCase):
+    """ Runs each test in a fresh directory to write books into."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_book(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(text.encode("utf-8"))
+        return path
+
+
+class BatchTest(BookTest):
+    def files(self):
+        """ The files under the directory, relative to it."""
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                found.append(os.path.relpath(os.path.join(root, name), self.directory))
+        return sorted(found)
+
+    def test_failed_book_is_not_skipped_on_rerun(self):
+        path = self.write_book("bad.xml", book_xml(bad_page=2))
+        for form in ("html", "epub", "split"):
+            self.assertEqual(xml_pdf.batch(self.directory, "w", 1, form=form), [path])
+            self.assertEqual(self.files(), ["bad.xml"])
+            self.assertEqual(xml_pdf.batch(self.directory, "w", 1, form=form), [path])
+
+    def test_untitled_books_get_their_own_output(self):
+        self.write_book("u1.xml", book_xml(title=None))
+        self.write_book("u2.xml", book_xml(title=None))
+        self.assertEqual(xml_pdf.batch(self.directory, "w", 1), [])
+        self.assertEqual(self.files(), ["u1.html", "u1.xml", "u2.html", "u2.xml"])
+
+    def test_same_output_fails(self):
+        for name in ("a", "b"):
+            os.mkdir(os.path.join(self.directory, name))
+            self.write_book(os.path.join(name, "book.xml"), book_xml())
+        manifest = self.write_book("books.txt", u"a/book.xml\nb/book.xml\n")
+        out_dir = os.path.join(self.directory, "out")
+        failed = xml_pdf.batch(manifest, "w", 1, out_dir)
+        self.assertEqual(failed, [os.path.join(self.directory, "b", "book.xml")])
+        self.assertEqual(os.listdir(out_dir), ["book.html"])
+
+
+@unittest.skipIf(np is None, "infer needs numpy")
+class InferTest(BookTest):
+    def infer(self, pages):
+        path = self.write_book("book.xml", layout_xml(pages))
+        return xml_pdf.PDFDoc(path, stream=True).infer_config()
+
+    def test_off_page_text(self):
+        expected = self.infer(indented_pages())
+        self.assertEqual(expected["strategy"], "indent")
+        pages = indented_pages()
+        # a line bleeding off the left edge, and a node just above the
+        # top of a page, which must not count towards the page before
+        pages[2][4] = (pages[2][4][0], -4, pages[2][4][2])
+        pages[3].insert(0, (-5, 50, u"off the top"))
+        self.assertEqual(self.infer(pages), expected)
+
+    def test_keeps_hand_set_options(self):
+        text = layout_xml(indented_pages()).replace(
+            u"<config ", u'<config columns="false" chapter_numbers="false" '
+        )
+        path = self.write_book("book.xml", text)
+        xml_pdf.infer(path)
+        doc = xml_pdf.PDFDoc(path)
+        self.assertEqual(doc.strategy, "indent")
+        self.assertFalse(doc.columns)
+        self.assertFalse(doc.chapter_numbers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,11 @@ Convert the pdf to xml with the command-line tool pdftohtml
 
 pdftohtml -xml [path to pdf] [path to exported xml file]
 
+Or skip the xml file: give xml_pdf the pdf itself and it runs
+pdftohtml -xml -stdout and reads its output a page at a time. The
+config, title and author elements (see Step 3) then go in a small
+file passed with --config.
+
 Step 2:
 Analyse the pdf
 
@@ -53,9 +58,50 @@ left: number of times a left margin of this turns up. Useful for determining 'pa
 
 font: number of lines that use this font class. Useful for determining default font.
 
+The counts are saved next to the xml in [xml file].analysis.json and
+reused while the xml is unchanged, so rerunning with different --diffs or
+--lefts is instant. Pass --refresh to force a new analysis.
+
+For a quick look at a huge book, --sample N analyzes only N pages, one
+from each stretch of the book (picked with --seed), and reports each
+count scaled up to the whole book with the margin it may be off by.
+Only those pages are read, and the estimate is not saved.
+
+For very large books add --stream (to analyze or write) so only one page
+of the xml is held in memory at a time. When writing, --jobs N parses
+the pages across N processes, each reading its pages straight from
+the xml (which, as with --incremental, needs pdftohtml's layout of
+<page> and </page> on their own lines). --output - writes the html to
+stdout, and --gzip compresses it.
+
+--epub writes an epub instead, with a file per chapter, always reading
+a page at a time as --stream does. --split writes one html file per
+chapter (cut at the chapter font) into a directory (--output, by
+default named after the title) with an index.html, so the
+chapters can be converted in parallel. Only the chapter files whose
+html changed are replaced, so after an edit only those need converting
+again.
+
+To convert a whole library at once pass a directory of xml files (or a
+manifest listing them) with --batch, plus -action as usual ("a" or
+write, with --epub, --split or --gzip). Books run across every core
+(or --jobs N), and a book is skipped if its output or analysis is
+newer than its xml. Each book's output is named after its xml file
+(book.xml gives book.html, book.epub or the directory book), and a
+book whose output would be the same as an earlier one's fails.
+
+To see where a slow conversion spends its time add --profile, which
+prints seconds, text nodes and memory peak per stage and for the
+--slowest N pages; --cprofile FILE also saves cProfile stats.
+
 Step 3:
 Update the xml with config values
 
+xml_pdf [path to xml file] -action infer
+proposes values from the layout statistics (needs numpy) and writes
+them into the xml as the config element. Check them against the
+analysis and adjust by hand.
+
 
 From the analysis, determine the values for the following
 configuration items:
@@ -82,6 +128,10 @@ strategy: for para_break, differentiate vertical, spaces, or indent
 
 chapter_numbers: add chapter numbers after chapter titles
 
+columns: pages with two or more columns of text are found by the gaps
+         between them and read one column at a time. Set to "false"
+         if a page that has one column is being split.
+
 Add a "title" tag for the name of the file and the title of the html
 Add an "author" tag for the name of the author
 
@@ -93,6 +143,10 @@ SAMPLE:
 Step 4:
 Manipulate the xml for better parsing by adding tags:
 
+While editing, write with --incremental: the rendered pages are cached in
+[xml file].pages.json and only pages whose xml (or the config) changed
+are parsed again.
+
 <footnote top="x"/>
 This tells the parser that everything at X and greater are footnotes
 (currently ignores)
@@ -116,30 +170,200 @@ Odd characters:
 
 Bad spacing:
 """
+from __future__ import print_function
+
 from argparse import ArgumentParser
+from array import array
+from bisect import bisect_right
 import codecs
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import cProfile
+import gzip
+import hashlib
+from itertools import chain, islice
+import json
+import math
+from multiprocessing import Pool, cpu_count
+import os
+import random
 import re
+import shutil
+from subprocess import PIPE, CalledProcessError, Popen
 import sys
-from xml.dom.minidom import parse
-
+import tempfile
+import time
+import uuid
+from xml.dom import pulldom
+from xml.dom.minidom import Document, parse, parseString
+from xml.parsers import expat
+from xml.sax import make_parser
+from xml.sax.handler import feature_external_ges
+from xml.sax.saxutils import escape, unescape
+import zipfile
+
+# Python 2 has neither; rename replaces the target on posix as well
+replace_file = getattr(os, "replace", os.rename)
+perf_counter = getattr(time, "perf_counter", time.time)
+# ZipFile.open can write a member from Python 3.6
+ZIP_STREAMS = sys.version_info >= (3, 6)
 SENTENCE_END = re.compile(u"[.?!](['\"\u201d\xbb]|\&quot;)?\s*$")
 STARTS_WITH_CAP = re.compile(u"^(['\"\xab\u201c]|\&quot;)?[A-Z]")
 LINK_TAG = re.compile(r"</?a\b[^>]*>")
+HEAD_TAGS = ("config", "title", "author", "fontspec")
+HEAD_PREFIXES = tuple(b"<" + tag.encode("ascii") for tag in HEAD_TAGS)
+# Pages handed to each worker per round when parsing with a process pool
+PAGE_BATCH = 8
+ANALYSIS_SUFFIX = ".analysis.json"
+PAGE_CACHE_SUFFIX = ".pages.json"
+CONFIG_ATTRIBUTES = (
+    "top_margin",
+    "bottom_margin",
+    "para_break",
+    "buf",
+    "default_font",
+    "chapter_font",
+    "strategy",
+    "chapter_numbers",
+    "columns",
+)
+# Width in xml units of the cells a page is split into to find columns
+COLUMN_CELL = 4
+# Fewest text nodes a column can have
+MIN_COLUMN_NODES = 4
+# Stands in for a chapter number in rendered html; cannot occur in xml text
+CHAPTER_MARK = u"\x00"
+# Bytes of html gathered before each write
+WRITE_BUFFER = 1 << 20
+CHAPTER_HEAD = u"""<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
+  "http://www.w3.org/TR/html4/strict.dtd">
+<html>
+  <head>
+  <meta http-equiv="content-type" content="text/html; charset=UTF-8">
+<title>{title}</title>
+<link rel="stylesheet" type="text/css" href="style.css">
+</head>
+<body>
+"""
+CHAPTER_FILE = re.compile(r"^c\d{3,}\.html$")
+EPUB_CONTAINER = u"""<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles>
+<rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>
+</rootfiles>
+</container>
+"""
+EPUB_PAGE_HEAD = u"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<meta charset="UTF-8"/>
+<title>{title}</title>
+<link rel="stylesheet" type="text/css" href="style.css"/>
+</head>
+<body>
+"""
+EPUB_OPF = u"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="bookid">urn:uuid:{id}</dc:identifier>
+<dc:title>{title}</dc:title>
+<dc:creator>{author}</dc:creator>
+<dc:language>en</dc:language>
+<meta property="dcterms:modified">{modified}</meta>
+</metadata>
+<manifest>
+<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+<item id="css" href="style.css" media-type="text/css"/>
+{manifest}
+</manifest>
+<spine toc="ncx">
+{spine}
+</spine>
+</package>
+"""
+EPUB_NCX = u"""<?xml version="1.0" encoding="UTF-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+<head><meta name="dtb:uid" content="urn:uuid:{id}"/></head>
+<docTitle><text>{title}</text></docTitle>
+<navMap>
+{nav_points}
+</navMap>
+</ncx>
+"""
+EPUB_NAV = u"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><meta charset="UTF-8"/><title>{title}</title></head>
+<body>
+<nav epub:type="toc"><ol>
+{items}
+</ol></nav>
+</body>
+</html>
+"""
+# Streams a pdf as xml; -i skips images, which are not used
+PDFTOHTML = ["pdftohtml", "-xml", "-stdout", "-i"]
 
 
 class PDFDoc(object):
     """XML representation of a PDFDoc."""
 
-    def __init__(self, path):
+    def __init__(
+        self, path, stream=False, jobs=1, profile=None, config=None, sample=0, seed=0
+    ):
+        """
+        params:
+        path: path to the pdftohtml xml file, or to a pdf to stream
+              through pdftohtml (always page at a time)
+        stream: if true, never hold the whole document in memory;
+                pages are read and parsed one at a time
+        jobs: how many processes to parse pages with
+        profile: a Profile to record stage timings in
+        config: path to a file with the config, title and author
+                elements, for a pdf
+        sample: analyze only this many pages, spread through the book
+        seed: random seed for picking the sampled pages
+        """
         self.path = path
-        self.doc = parse(path)
-        self.fonts = {}
+        self.pdf = path.lower().endswith(".pdf")
+        self.stream = stream or self.pdf
+        self.jobs = jobs
+        self.profile = profile or NullProfile()
+        self.sample = sample
+        self.seed = seed
+        # in document order, so the css comes out the same every run
+        self.fonts = OrderedDict()
         self.pages = {}
-
-        self.title = text_value(self.doc, "title") or ""
-        self.html_file = u"{}.html".format(self.title.lower().replace(u" ", u"_"))
-        self.author = text_value(self.doc, "author")
+        # number of the first chapter heading on each parsed page
+        self.chapter_starts = {}
+        with self.profile.stage("read xml"):
+            if self.pdf:
+                self.doc = None
+                head = read_config_file(config)
+            elif sample or jobs > 1:
+                # only the sampled pages are read, or the pool workers
+                # parse each page from its bytes
+                self.doc = None
+                head, self.page_offsets = page_index(path)
+            elif stream:
+                self.doc = None
+                head = self.read_head()
+            else:
+                self.doc = parse(path)
+                head = self.doc
+        with self.profile.stage("fonts"):
+            self.read_config(head)
+
+    def read_config(self, head):
+        """ Sets the title, author, config values and fonts."""
+
+        self.title = text_value(head, "title") or ""
+        if self.pdf and not self.title:
+            self.title = os.path.splitext(os.path.basename(self.path))[0]
+        self.html_file = html_name(self.title)
+        self.author = text_value(head, "author")
         self.top_margin = 0
         self.bottom_margin = 0
         self.para_break = 0
@@ -147,7 +371,9 @@ class PDFDoc(object):
         self.default_font = None
         self.chapter_font = None
         self.strategy = "vertical"
-        for config in self.doc.getElementsByTagName("config"):
+        self.chapter_numbers = True
+        self.columns = True
+        for config in head.getElementsByTagName("config"):
             self.top_margin = int(config.getAttribute("top_margin"))
             self.bottom_margin = int(config.getAttribute("bottom_margin"))
             self.para_break = int(config.getAttribute("para_break"))
@@ -156,61 +382,364 @@ class PDFDoc(object):
             self.chapter_font = config.getAttribute("chapter_font")
             self.strategy = config.getAttribute("strategy") or "vertical"
             if config.getAttribute("chapter_numbers") == "false":
-                Line.USE_CHAPTER_NUMBERS = False
+                self.chapter_numbers = False
+            if config.getAttribute("columns") == "false":
+                self.columns = False
             break
-        default_font_size = 1.0
-        for fontspec in self.doc.getElementsByTagName("fontspec"):
-            font = Font(fontspec)
-            if not self.default_font or font.index == self.default_font:
-                font.default = True
-                default_font_size = float(font.size_pt)
-            if font.index == self.chapter_font:
-                font.chapter = True
-            self.fonts[font.index] = font
-
+        self.default_font_size = 1.0
+        for fontspec in head.getElementsByTagName("fontspec"):
+            self.add_font(Font(fontspec))
+        self.size_fonts()
+
+    def add_font(self, font):
+        if not self.default_font or font.index == self.default_font:
+            font.default = True
+            self.default_font_size = float(font.size_pt)
+        if font.index == self.chapter_font:
+            font.chapter = True
+        self.fonts[font.index] = font
+
+    def size_fonts(self):
+        """ Sets the size of each font relative to the default font."""
         for font in self.fonts.values():
-            font.size_pct = int((font.size_pt / default_font_size) * 100)
+            font.size_pct = int((font.size_pt / self.default_font_size) * 100)
+
+    def read_head(self):
+        """ Scans the xml once with expat, keeping only the config, title,
+        author and fontspec nodes in a small detached element."""
+        doc = Document()
+        head = doc.createElement("head")
+        current = []
+
+        def start(name, attrs):
+            if name in HEAD_TAGS:
+                node = doc.createElement(name)
+                for k, v in attrs.items():
+                    node.setAttribute(k, v)
+                head.appendChild(node)
+                current.append(node)
+
+        def end(name):
+            if name in HEAD_TAGS:
+                current.pop()
+
+        def characters(data):
+            if current:
+                current[-1].appendChild(doc.createTextNode(data))
+
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = characters
+        parser.buffer_text = True
+        with open(self.path, "rb") as f:
+            parser.ParseFile(f)
+        return head
+
+    def page_nodes(self):
+        """ Yields the page nodes in document order.
+        When streaming, each node is built only when reached and is
+        dropped once the caller lets go of it."""
+        if self.doc is not None:
+            for page in self.doc.getElementsByTagName("page"):
+                yield page
+            return
+        if not self.pdf:
+            events = page_events(self.path)
+            for event, node in events:
+                if event == pulldom.START_ELEMENT and node.tagName == "page":
+                    with self.profile.stage("expand page"):
+                        events.expandNode(node)
+                    yield node
+            return
+        # pdftohtml declares each font in the first page that uses it
+        command = PDFTOHTML + [self.path]
+        process = Popen(command, stdout=PIPE)
+        try:
+            events = page_events(process.stdout)
+            for event, node in events:
+                if event == pulldom.START_ELEMENT and node.tagName == "page":
+                    with self.profile.stage("expand page"):
+                        events.expandNode(node)
+                    for fontspec in node.getElementsByTagName("fontspec"):
+                        if fontspec.getAttribute("id") not in self.fonts:
+                            self.add_font(Font(fontspec))
+                    yield node
+        except Exception:
+            # bad xml is most likely pdftohtml failing part way
+            process.stdout.close()
+            if process.wait():
+                raise CalledProcessError(process.returncode, command)
+            raise
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode:
+            raise CalledProcessError(returncode, command)
+
+    def iter_pages(self):
+        """ Yields parsed, non-ignored pages one at a time in document order.
+        Pages piped from a pdf are parsed serially, as workers would
+        need fonts that are only found along the way."""
+        if self.jobs > 1 and not self.pdf:
+            return self.pooled_pages()
+        return self.serial_pages()
+
+    def serial_pages(self):
+        for node in self.page_nodes():
+            p = Page(
+                node,
+                self.fonts,
+                self.top_margin,
+                self.bottom_margin,
+                self.buf,
+                self.columns,
+            )
+            if p.ignore:
+                continue
+            with self.profile.stage("group lines") as stage:
+                p.parse()
+                stage.nodes = p.nodes
+                stage.page = p.number
+            p.node = None
+            yield p
+
+    def pooled_pages(self):
+        """ Parses pages across a pool of self.jobs processes.
+        The raw bytes of each page are read at the offsets page_index
+        found and go out in batches, so no page is built in this process
+        and only a few pages per worker are in flight. They come back in
+        document order."""
+
+        def chunks():
+            with open(self.path, "rb") as f:
+                for start, end in self.page_offsets:
+                    f.seek(start)
+                    yield f.read(end - start)
+
+        work = chunks()
+        settings = (
+            self.fonts,
+            self.top_margin,
+            self.bottom_margin,
+            self.buf,
+            self.columns,
+        )
+        pool = Pool(self.jobs, initializer=init_worker, initargs=settings)
+        try:
+            while True:
+                batch = list(islice(work, self.jobs * PAGE_BATCH))
+                if not batch:
+                    break
+                with self.profile.stage("group lines") as stage:
+                    pages = [p for p in pool.map(parse_page, batch) if p is not None]
+                    stage.nodes = sum(p.nodes for p in pages)
+                for p in pages:
+                    yield p
+        finally:
+            pool.terminate()
 
     def parse(self):
-        for page in self.doc.getElementsByTagName("page"):
-            p = Page(page, self.fonts, self.top_margin, self.bottom_margin, self.buf)
-            p.parse()
-            if not p.ignore:
-                self.pages[p.number] = p
-
-    def write_html(self):
-        """ HTML representation of the doc, written to path."""
-        print("writing", self.html_file)
-        with codecs.open(self.html_file, mode="wb", encoding="utf-8") as f:
-            f.write(self.header)
-            last_line = None
-            for page in sorted(self.pages.values(), key=lambda x: x.number):
+        for p in self.iter_pages():
+            self.pages[p.number] = p
+        self.number_chapters()
+
+    def number_chapters(self):
+        """ Counts the chapter headings of the parsed pages in order, so
+        each page knows its chapter numbers before any is rendered."""
+        self.chapter_starts = {}
+        number = 1
+        for page in sorted(self.pages.values(), key=lambda x: x.number):
+            self.chapter_starts[page.number] = number
+            number += page.chapters
+
+    def render_page(self, page):
+        """ Renders the lines of a parsed page into a PageFragment."""
+        with self.profile.stage("sort lines", len(page.lines), page.number):
+            lines = sorted(page.lines.values(), key=lambda x: (x.column, x.top))
+        with self.profile.stage("render", len(lines), page.number):
+            return self.render_lines(page.number, lines, page.column_shifts)
+
+    def render_lines(self, number, lines, column_shifts=(0,)):
+        """ column_shifts: how far right of the first column each column
+        starts, taken off the left of its lines for the indent strategy."""
+        lead = u""
+        parts = []
+        last_top = 0
+        last_line = None
+        last_column = 0
+        for line in lines:
+            if line.column != last_column:
+                # a new column carries on like a new page
                 last_top = 0
-                f.write("<!-- Page {} -->\n".format(page.number))
-                for line in sorted(page.lines.values(), key=lambda x: x.top):
-                    if self.strategy == "vertical":
-                        line_diff = line.top - last_top
-                        if last_top != 0:
-                            if line_diff > (2 * self.para_break):
-                                f.write("<p>-<p>\n")
-                            elif line.top - last_top > self.para_break:
-                                f.write("<p>\n")
-                        elif (
-                            last_line
-                            and last_line.ends_sentence
-                            and line.begins_sentence
-                        ):
-                            f.write("<p>\n")
-                    elif self.strategy == "spaces":
-                        if line.text.startswith("      "):
-                            f.write("<p>\n")
-                    elif self.strategy == "indent":
-                        if line.left > self.para_break:
-                            f.write("<p>\n")
-                    f.write(line.html_text)
-                    f.write("\n")
-                    last_top = line.top
-                    last_line = line
+                last_column = line.column
+            if self.strategy == "vertical":
+                line_diff = line.top - last_top
+                if last_top != 0:
+                    if line_diff > (2 * self.para_break):
+                        parts.append(u"<p>-<p>\n")
+                    elif line.top - last_top > self.para_break:
+                        parts.append(u"<p>\n")
+                elif last_line is None:
+                    # Depends on how the previous page ended
+                    if line.begins_sentence:
+                        lead = u"<p>\n"
+                elif last_line.ends_sentence and line.begins_sentence:
+                    parts.append(u"<p>\n")
+            elif self.strategy == "spaces":
+                if line.text.startswith("      "):
+                    parts.append(u"<p>\n")
+            elif self.strategy == "indent":
+                if line.left - column_shifts[line.column] > self.para_break:
+                    parts.append(u"<p>\n")
+            parts.append(line.html_text)
+            parts.append(u"\n")
+            last_top = line.top
+            last_line = line
+        ends = None if last_line is None else bool(last_line.ends_sentence)
+        html = u"".join(parts)
+        return PageFragment(number, lead, html, ends, html.count(CHAPTER_MARK))
+
+    def fragments(self):
+        """ Yields the fragment of every page to write."""
+        if self.pages:
+            pages = sorted(self.pages.values(), key=lambda x: x.number)
+        else:
+            pages = self.iter_pages()
+        for page in pages:
+            yield self.render_page(page)
+
+    def cached_fragments(self):
+        """ Yields the fragment of every page to write, only parsing and
+        rendering the pages whose xml or config changed since last run.
+        Rewrites the page cache next to the xml when done."""
+        cache_path = self.path + PAGE_CACHE_SUFFIX
+        cache = {}
+        if os.path.exists(cache_path):
+            with codecs.open(cache_path, encoding="utf-8") as f:
+                cache = json.load(f)
+        config = self.config_digest
+        new_cache = {}
+        rendered = 0
+        total = 0
+        for chunk in page_chunks(self.path):
+            total += 1
+            key = hashlib.sha1(config + chunk).hexdigest()
+            if key in cache:
+                record = cache[key]
+            else:
+                p = Page(
+                    parseString(chunk).documentElement,
+                    self.fonts,
+                    self.top_margin,
+                    self.bottom_margin,
+                    self.buf,
+                    self.columns,
+                )
+                record = None
+                if not p.ignore:
+                    with self.profile.stage("group lines") as stage:
+                        p.parse()
+                        stage.nodes = p.nodes
+                        stage.page = p.number
+                    record = self.render_page(p).__dict__
+                rendered += 1
+            new_cache[key] = record
+            if record is not None:
+                yield PageFragment(**record)
+        with codecs.open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(new_cache, f, separators=(",", ":"))
+        print("rendered {} of {} pages".format(rendered, total), file=sys.stderr)
+
+    @property
+    def config_digest(self):
+        """ Bytes identifying every setting that changes how a page renders."""
+        settings = [
+            self.top_margin,
+            self.bottom_margin,
+            self.para_break,
+            self.buf,
+            self.strategy,
+            self.columns,
+        ]
+        for index in sorted(self.fonts):
+            font = self.fonts[index]
+            settings.append([index, font.default, font.chapter])
+        return json.dumps(settings).encode("utf-8")
+
+    def html_chunks(self, fragments):
+        """ Yields the html of the pages, one string per page with
+        chapter numbers filled in."""
+        ends_sentence = False
+        chapter = 1
+        for fragment in fragments:
+            # pages streamed rather than parsed up front are numbered
+            # by counting as they go, which comes to the same thing
+            chapter = self.chapter_starts.get(fragment.number, chapter)
+            parts = [u"<!-- Page {} -->\n".format(fragment.number)]
+            if ends_sentence:
+                parts.append(fragment.lead)
+            parts.append(fragment.numbered(chapter, self.chapter_numbers))
+            chapter += fragment.chapters
+            if fragment.ends is not None:
+                ends_sentence = fragment.ends
+            yield u"".join(parts)
+
+    def write_html(self, incremental=False, output=None, compress=False):
+        """ HTML representation of the doc, written to path.
+        Uses the parsed pages if there are any, otherwise parses
+        and writes the pages one at a time.
+        With incremental, unchanged pages come from the page cache.
+
+        params:
+        output: path to write to, "-" for stdout; defaults to the
+                html file named after the title
+        compress: gzip the html
+        """
+        if incremental:
+            fragments = self.cached_fragments()
+        else:
+            fragments = self.fragments()
+        if output is None:
+            output = self.html_file + (".gz" if compress else "")
+        print("writing", output, file=sys.stderr)
+        if output == "-":
+            stdout = getattr(sys.stdout, "buffer", sys.stdout)
+            f = gzip.GzipFile(fileobj=stdout, mode="wb") if compress else stdout
+            try:
+                self.write_document(f, fragments)
+            finally:
+                if f is stdout:
+                    f.flush()
+                else:
+                    f.close()
+            return
+        with output_file(output) as tmp_path:
+            f = gzip.open(tmp_path, "wb") if compress else open(tmp_path, "wb")
+            try:
+                self.write_document(f, fragments)
+            finally:
+                f.close()
+
+    def write_document(self, f, fragments):
+        """ Writes the header and the html of the fragments to f."""
+        if self.pdf:
+            # the css needs every font, and those are only known once
+            # the last page is read, so the pages are spooled first
+            with tempfile.TemporaryFile() as body:
+                self.write_chunks(body, self.html_chunks(fragments))
+                self.size_fonts()
+                self.write_chunks(f, [self.header])
+                body.seek(0)
+                shutil.copyfileobj(body, f, WRITE_BUFFER)
+        else:
+            chunks = chain([self.header], self.html_chunks(fragments))
+            self.write_chunks(f, chunks)
+
+    def write_chunks(self, f, chunks):
+        for chunk in buffered(chunks):
+            with self.profile.stage("write"):
+                f.write(chunk)
 
     @property
     def header(self):
@@ -232,7 +761,11 @@ class PDFDoc(object):
 
     @property
     def css(self):
-        css_text = '<style type="text/css">\n'
+        return u'<style type="text/css">\n{}</style>'.format(self.css_rules)
+
+    @property
+    def css_rules(self):
+        css_text = ""
         if self.default_font:
             for font in self.fonts.values():
                 if font.default:
@@ -245,72 +778,674 @@ class PDFDoc(object):
         css_text += "p{text-indent:1.5em;margin:0}\n"
         css_text += "p.section{text-indent:0;margin-top:1em}\n"
         css_text += "p.author{text-indent:0;margin-top:1em;page-break-after:always;}\n"
-        css_text += "</style>"
         return css_text
 
+    def write_epub(self, output=None):
+        """ EPUB of the doc, one xhtml file per chapter, written page
+        by page into the zip so the book is never held in memory."""
+        if output is None:
+            output = os.path.splitext(self.html_file)[0] + ".epub"
+        print("writing", output, file=sys.stderr)
+        with output_file(output) as tmp_path:
+            with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zf:
+                book = EpubWriter(zf, self.title, self.author)
+                for html in self.html_chunks(self.fragments()):
+                    book.add_page(html)
+                self.size_fonts()
+                book.close(self.css_rules)
+
+    def write_chapters(self, incremental=False, output=None):
+        """ HTML of the doc split at the chapter headings, one file per
+        chapter in the directory output (by default named after the
+        title), with an index.html listing them.
+        Only the files whose content changed are replaced."""
+        if incremental:
+            fragments = self.cached_fragments()
+        else:
+            fragments = self.fragments()
+        if output is None:
+            output = os.path.splitext(self.html_file)[0]
+        print("writing", output, file=sys.stderr)
+        book = ChapterWriter(output, self.title, self.author)
+        try:
+            for html in self.html_chunks(fragments):
+                with self.profile.stage("write"):
+                    book.add_page(html)
+        except BaseException:
+            # index.html is only written by close, so a batch will not
+            # take the chapters replaced so far for a finished book
+            book.discard()
+            raise
+        self.size_fonts()
+        book.close(self.css_rules)
+        print(
+            "replaced {} of {} files".format(book.replaced, book.files), file=sys.stderr
+        )
+
     def analyze(self):
-        height_diff_ctr = Counter()
-        font_ctr = Counter()
-        left_ctr = Counter()
-        max_length = defaultdict(lambda: 0)
-        font_examples = {}
-        diff_examples = {}
-        left_examples = {}
-        for page in self.doc.getElementsByTagName("page"):
-            lines = {}
-            top = 0
-            for line in page.getElementsByTagName("text"):
-                new_line = Line(line, self.fonts)
-                if not new_line.font in font_examples:
-                    font_examples[new_line.font.css_class] = new_line.text
-                font_ctr[new_line.font] += 1
-                if new_line.top in lines.keys():
-                    old_line = lines[new_line.top]
-                    if new_line.left < old_line.left:
-                        old_line.text = u"{} {}".format(new_line.text, old_line.text)
-                    else:
-                        old_line.text = u"{} {}".format(old_line.text, new_line.text)
+        """ Counts line diffs, left margins and fonts across all pages,
+        or across a sample of them when self.sample is set."""
+        if self.sample:
+            return self.analyze_sample()
+        analysis = Analysis(file_digest(self.path))
+        for page in self.page_nodes():
+            with self.profile.stage("analyze") as stage:
+                stage.page = int(page.getAttribute("number"))
+                stage.nodes = self.analyze_page(page, analysis)
+        return analysis
+
+    def analyze_sample(self):
+        """ Analyzes self.sample pages, one picked at random from each of
+        that many equal runs of pages, so every part of the book is seen.
+        Only the sampled pages are read from the file."""
+        total = len(self.page_offsets)
+        count = min(self.sample, total)
+        rng = random.Random(self.seed)
+        picked = [
+            rng.randrange(idx * total // count, (idx + 1) * total // count)
+            for idx in range(count)
+        ]
+        analysis = SampledAnalysis(total)
+        with open(self.path, "rb") as f:
+            for idx in picked:
+                start, end = self.page_offsets[idx]
+                f.seek(start)
+                page_analysis = Analysis(None)
+                with self.profile.stage("analyze") as stage:
+                    page = parseString(f.read(end - start)).documentElement
+                    stage.page = int(page.getAttribute("number"))
+                    stage.nodes = self.analyze_page(page, page_analysis)
+                analysis.add_page(page_analysis)
+        return analysis
+
+    def analyze_page(self, page, analysis):
+        """ Adds the lines of a page node to analysis.
+        Returns the number of text nodes."""
+        lines = {}
+        nodes = page.getElementsByTagName("text")
+        for line in nodes:
+            new_line = Line(line, self.fonts)
+            analysis.add_font(new_line.font.css_class, new_line.text)
+            if new_line.top in lines:
+                old_line = lines[new_line.top]
+                if new_line.left < old_line.left:
+                    old_line.text = u"{} {}".format(new_line.text, old_line.text)
+                else:
+                    old_line.text = u"{} {}".format(old_line.text, new_line.text)
+            else:
+                lines[new_line.top] = new_line
+        first = True
+        top = 0
+        for line in sorted(lines.values(), key=lambda x: x.top):
+            analysis.add_left(line.left, line.text)
+            if line.top < 1134:
+                if first:
+                    first = False
                 else:
-                    lines[new_line.top] = new_line
-            first = True
-            hold_line = None
-            printed = False
-            for line in sorted(lines.values(), key=lambda x: x.top):
-                if not line.left in left_examples:
-                    left_examples[line.left] = line.text
-                left_ctr[line.left] += 1
-                if line.top < 1134:
-                    if first:
-                        first = False
-                    else:
-                        diff = line.top - top
-                        if not diff in diff_examples:
-                            diff_examples[diff] = line.text
-                        height_diff_ctr[diff] += 1
-                    top = line.top
-                    hold_line = line
-
-        for k, v in height_diff_ctr.most_common(10):
+                    analysis.add_diff(line.top - top, line.text)
+                top = line.top
+        return len(nodes)
+
+    def layout_columns(self):
+        """ Scans the xml with expat into int arrays with one entry per
+        non-blank text node: page index, top, left and font id.
+        Also returns the page heights and the font ids in column order."""
+        columns = dict((name, array("i")) for name in ("page", "top", "left", "font"))
+        heights = array("i")
+        font_ids = []
+        font_columns = {}
+        current = []
+
+        def start(name, attrs):
+            if name == "page":
+                heights.append(int(attrs.get("height", 0)))
+            elif name == "text":
+                current.append(attrs)
+
+        def characters(data):
+            if current and current[0] is not None and data.strip():
+                attrs = current.pop()
+                current.append(None)
+                font = attrs["font"]
+                if font not in font_columns:
+                    font_columns[font] = len(font_ids)
+                    font_ids.append(font)
+                columns["page"].append(len(heights) - 1)
+                columns["top"].append(int(attrs["top"]))
+                columns["left"].append(int(attrs["left"]))
+                columns["font"].append(font_columns[font])
+
+        def end(name):
+            if name == "text":
+                current.pop()
+
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = characters
+        with open(self.path, "rb") as f:
+            parser.ParseFile(f)
+        return columns, heights, font_ids
+
+    def infer_config(self):
+        """ Proposes config values from the layout of every text node.
+
+        Nodes whose tops are within a small distance are merged into
+        lines, the most common distance between lines is the line
+        spacing, and a line that sits at the same top on most pages with
+        more than the usual spacing before the body is a header (or
+        footer). Paragraphs are vertical if a wider spacing cluster is
+        common enough, otherwise indented if a second left margin is.
+        """
+        import numpy as np
+
+        columns, heights, font_ids = self.layout_columns()
+        page = np.asarray(columns["page"], dtype=np.int64)
+        # text bleeding off the page has a negative top or left; at the
+        # edge it still counts towards its own page and the margins
+        top = np.maximum(np.asarray(columns["top"], dtype=np.int64), 0)
+        left = np.maximum(np.asarray(columns["left"], dtype=np.int64), 0)
+        font = np.asarray(columns["font"], dtype=np.int64)
+        config = {"strategy": "vertical"}
+        if not top.size:
+            return config
+
+        font_counts = np.bincount(font)
+        default = int(font_counts.argmax())
+        config["default_font"] = font_ids[default]
+
+        # Distinct tops per page, in page then top order
+        span = int(top.max()) + 1
+        keys, node_keys = np.unique(page * span + top, return_inverse=True)
+        key_page = keys // span
+        key_top = keys % span
+        same_page = key_page[1:] == key_page[:-1]
+        key_diffs = np.diff(key_top)
+
+        spacing = mode(key_diffs[same_page & (key_diffs > 0)], 1)
+        # Tops within half a spacing of the line's first top are one line
+        starts = np.ones(keys.size, dtype=bool)
+        starts[1:] = ~same_page | (key_diffs >= max(spacing // 2, 1))
+        start_index = np.maximum.accumulate(np.where(starts, np.arange(keys.size), 0))
+        jitter = int((key_top - key_top[start_index]).max())
+        config["buf"] = jitter + 1 if jitter else 0
+
+        line_page = key_page[starts]
+        line_top = key_top[starts]
+        line_of_key = np.cumsum(starts) - 1
+        line_left = np.full(line_top.size, span * 1000, dtype=np.int64)
+        np.minimum.at(line_left, line_of_key[node_keys], left)
+        line_same_page = line_page[1:] == line_page[:-1]
+        line_diffs = np.diff(line_top)
+        spacing = mode(line_diffs[line_same_page], spacing)
+
+        first = np.ones(line_top.size, dtype=bool)
+        first[1:] = ~line_same_page
+        last = np.ones(line_top.size, dtype=bool)
+        last[:-1] = ~line_same_page
+        gap_after = np.zeros(line_top.size, dtype=np.int64)
+        gap_after[:-1] = np.where(line_same_page, line_diffs, 0)
+        gap_before = np.zeros(line_top.size, dtype=np.int64)
+        gap_before[1:] = np.where(line_same_page, line_diffs, 0)
+
+        pages = len(heights)
+        buf = config["buf"]
+        config["top_margin"] = 0
+        header = band(line_top[first], gap_after[first], pages, spacing, buf)
+        if header is not None:
+            config["top_margin"] = header + buf + 1
+        config["bottom_margin"] = max(heights) if heights else int(top.max())
+        footer = band(line_top[last], gap_before[last], pages, spacing, buf)
+        if footer is not None:
+            config["bottom_margin"] = footer - buf - 1
+
+        body = (line_top >= config["top_margin"]) & (
+            line_top <= config["bottom_margin"]
+        )
+        body_pairs = line_same_page & body[1:] & body[:-1]
+        body_diffs = line_diffs[body_pairs]
+        spacing = mode(body_diffs, spacing)
+        wide = body_diffs[body_diffs > spacing + spacing // 2]
+        if wide.size >= 0.02 * max(body_diffs.size, 1):
+            # just under halfway, so that a gap of three line spacings
+            # is still more than twice it and reads as a section break
+            config["para_break"] = (spacing + mode(wide, 2 * spacing)) // 2 - 1
+        else:
+            body_lefts = line_left[body]
+            margin = mode(body_lefts, 0)
+            indents = body_lefts[body_lefts > margin]
+            indent = mode(indents, 0)
+            if indent and np.count_nonzero(indents == indent) >= 0.05 * body_lefts.size:
+                config["strategy"] = "indent"
+                config["para_break"] = (margin + indent) // 2
+            else:
+                config["para_break"] = spacing + spacing // 2
+
+        # Chapter headings: a font clearly bigger than the body text that
+        # turns up on several pages but only a line or two at a time
+        default_size = self.fonts[font_ids[default]].size_pt
+        font_pages = np.bincount(np.unique(page * len(font_ids) + font) % len(font_ids))
+        best = None
+        for idx, font_id in enumerate(font_ids):
+            size = self.fonts[font_id].size_pt
+            if size < 1.2 * default_size or font_pages[idx] < 2:
+                continue
+            if font_counts[idx] > 3 * font_pages[idx]:
+                continue
+            rank = (font_pages[idx], size)
+            if best is None or rank > best[0]:
+                best = (rank, font_id)
+        if best is not None:
+            config["chapter_font"] = best[1]
+        return config
+
+
+class ChapterWriter(object):
+    """ Writes the page html of a PDFDoc as one html file per chapter.
+
+    The front matter goes in c000.html and each chapter heading starts
+    the next file. The files share a style.css, written last so a pdf
+    read a page at a time has all its fonts, and index.html links them.
+    Each file is written to a temp file first and only replaces the old
+    one if it differs, so after an edit only the chapters it touched
+    are new and need converting again.
+    """
+
+    def __init__(self, directory, title, author):
+        self.directory = directory
+        self.title = title or u""
+        self.chapters = []
+        self.current = None
+        self.files = 0
+        self.replaced = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.start_file(self.title)
+        self.current.write(
+            u'<h1>{}</h1>\n<p class="author">by {}\n\n'.format(
+                self.title, author
+            ).encode("utf-8")
+        )
+
+    def start_file(self, title):
+        if self.current is not None:
+            self.end_file()
+        name = u"c{:03}.html".format(len(self.chapters))
+        self.chapters.append((name, title))
+        self.current = tempfile.NamedTemporaryFile(
+            dir=self.directory, suffix=".tmp", delete=False
+        )
+        self.current.write(CHAPTER_HEAD.format(title=title).encode("utf-8"))
+
+    def end_file(self):
+        self.current.write(b"</body>\n</html>\n")
+        self.current.close()
+        self.replace(self.current.name, self.chapters[-1][0])
+        self.current = None
+
+    def discard(self):
+        """ Drops the chapter being written, after a failure."""
+        self.current.close()
+        os.remove(self.current.name)
+        self.current = None
+
+    def replace(self, tmp_path, name):
+        """ Moves the temp file over the file called name in the
+        directory if that is missing or different, else drops it."""
+        path = os.path.join(self.directory, name)
+        self.files += 1
+        if os.path.exists(path) and file_digest(path) == file_digest(tmp_path):
+            os.remove(tmp_path)
+        else:
+            # temp files are private; these go on to other tools
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            replace_file(tmp_path, path)
+            self.replaced += 1
+
+    def write_file(self, name, text):
+        with tempfile.NamedTemporaryFile(
+            dir=self.directory, suffix=".tmp", delete=False
+        ) as f:
+            f.write(text.encode("utf-8"))
+        self.replace(f.name, name)
+
+    def add_page(self, html):
+        parts = []
+        for line in html.splitlines(True):
+            if u"<h2>" in line:
+                self.current.write(u"".join(parts).encode("utf-8"))
+                parts = []
+                self.start_file(
+                    u" ".join(
+                        re.sub(u"<[^>]+>", u"", h)
+                        for h in re.findall(u"<h2>(.*?)</h2>", line)
+                    )
+                )
+            parts.append(line)
+        self.current.write(u"".join(parts).encode("utf-8"))
+
+    def close(self, css):
+        """ Ends the last chapter, writes the css and index, and removes
+        chapter files left over from a longer earlier version."""
+        self.end_file()
+        self.write_file(u"style.css", css)
+        items = u"\n".join(
+            u'<li><a href="{}">{}</a></li>'.format(name, title)
+            for name, title in self.chapters
+        )
+        self.write_file(
+            u"index.html",
+            CHAPTER_HEAD.format(title=self.title)
+            + u"<h1>{}</h1>\n<ol>\n{}\n</ol>\n</body>\n</html>\n".format(
+                self.title, items
+            ),
+        )
+        names = set(name for name, _ in self.chapters)
+        for name in os.listdir(self.directory):
+            if CHAPTER_FILE.match(name) and name not in names:
+                os.remove(os.path.join(self.directory, name))
+
+
+class EpubWriter(object):
+    """ Turns the page html of a PDFDoc into an EPUB 3 container.
+
+    Each line of page html is a paragraph break, a section break or a
+    line of text, so paragraphs are closed properly for xhtml as the
+    lines go by. A line with a chapter heading starts a new file.
+    Only the chapter titles are kept for the table of contents.
+    """
+
+    def __init__(self, zf, title, author):
+        self.zf = zf
+        self.title = title or u""
+        self.author = author or u""
+        self.chapters = []
+        self.current = None
+        self.in_paragraph = False
+        zf.writestr(
+            zipfile.ZipInfo("mimetype"),
+            "application/epub+zip",
+            compress_type=zipfile.ZIP_STORED,
+        )
+        zf.writestr("META-INF/container.xml", EPUB_CONTAINER.encode("utf-8"))
+        self.start_file(self.title)
+        self.current.write(
+            u'<h1>{}</h1>\n<p class="author">by {}</p>\n'.format(
+                escape(self.title), escape(self.author)
+            ).encode("utf-8")
+        )
+
+    def start_file(self, title):
+        if self.current is not None:
+            self.end_file()
+        name = u"c{}.xhtml".format(len(self.chapters))
+        self.chapters.append((name, title))
+        if ZIP_STREAMS:
+            self.current = self.zf.open(name, "w")
+        else:
+            self.current = SpooledMember(self.zf, name)
+        self.current.write(EPUB_PAGE_HEAD.format(title=escape(title)).encode("utf-8"))
+
+    def end_file(self):
+        parts = self.close_paragraph([])
+        parts.append(u"</body>\n</html>\n")
+        self.current.write(u"".join(parts).encode("utf-8"))
+        self.current.close()
+        self.current = None
+
+    def close_paragraph(self, parts):
+        if self.in_paragraph:
+            parts.append(u"</p>\n")
+            self.in_paragraph = False
+        return parts
+
+    def add_page(self, html):
+        parts = []
+        for line in html.splitlines():
+            if line == u"<p>":
+                self.close_paragraph(parts)
+            elif line == u"<p>-<p>":
+                self.close_paragraph(parts).append(u"<p>-</p>\n")
+            elif line.startswith(u"<!--"):
+                parts.append(line + u"\n")
+            elif u"<h2>" in line:
+                self.current.write(u"".join(self.close_paragraph(parts)).encode("utf-8"))
+                parts = []
+                # the page html is escaped already, and the title is
+                # escaped again wherever it is written
+                title = unescape(
+                    u" ".join(
+                        re.sub(u"<[^>]+>", u"", h)
+                        for h in re.findall(u"<h2>(.*?)</h2>", line)
+                    ),
+                    {u"&quot;": u'"'},
+                )
+                self.start_file(title)
+                parts.append(line + u"\n")
+            else:
+                if not self.in_paragraph:
+                    parts.append(u"<p>")
+                    self.in_paragraph = True
+                parts.append(line + u"\n")
+        self.current.write(u"".join(parts).encode("utf-8"))
+
+    def close(self, css):
+        """ Ends the last chapter and writes the css, package and tables
+        of contents."""
+        self.end_file()
+        self.zf.writestr("style.css", css.encode("utf-8"))
+        # uuid5, which on Python 2 cannot take a unicode name
+        name = u"{}/{}".format(self.title, self.author).encode("utf-8")
+        digest = hashlib.sha1(uuid.NAMESPACE_URL.bytes + name).digest()
+        book_id = uuid.UUID(bytes=digest[:16], version=5)
+        manifest = []
+        spine = []
+        nav_points = []
+        nav_items = []
+        for idx, (name, title) in enumerate(self.chapters):
+            manifest.append(
+                u'<item id="c{}" href="{}" media-type="application/xhtml+xml"/>'.format(
+                    idx, name
+                )
+            )
+            spine.append(u'<itemref idref="c{}"/>'.format(idx))
+            nav_points.append(
+                u'<navPoint id="n{0}" playOrder="{1}"><navLabel><text>{2}</text>'
+                u'</navLabel><content src="{3}"/></navPoint>'.format(
+                    idx, idx + 1, escape(title), name
+                )
+            )
+            nav_items.append(u'<li><a href="{}">{}</a></li>'.format(name, escape(title)))
+        self.zf.writestr(
+            "content.opf",
+            EPUB_OPF.format(
+                id=book_id,
+                title=escape(self.title),
+                author=escape(self.author),
+                modified=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                manifest=u"\n".join(manifest),
+                spine=u"\n".join(spine),
+            ).encode("utf-8"),
+        )
+        self.zf.writestr(
+            "toc.ncx",
+            EPUB_NCX.format(
+                id=book_id, title=escape(self.title), nav_points=u"\n".join(nav_points)
+            ).encode("utf-8"),
+        )
+        self.zf.writestr(
+            "nav.xhtml",
+            EPUB_NAV.format(
+                title=escape(self.title), items=u"\n".join(nav_items)
+            ).encode("utf-8"),
+        )
+
+
+class SpooledMember(object):
+    """ Stands in for ZipFile.open(name, "w") where that is missing:
+    the member is written to a temp file and added to the zip on close."""
+
+    def __init__(self, zf, name):
+        self.zf = zf
+        self.name = name
+        self.file = tempfile.NamedTemporaryFile(suffix=".tmp")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.flush()
+        self.zf.write(self.file.name, self.name)
+        self.file.close()
+
+
+class Analysis(object):
+    """ Histograms of line diffs, left margins and fonts with an example
+    of each, saved next to the xml and keyed by a hash of its content."""
+
+    def __init__(self, digest):
+        self.digest = digest
+        self.diffs = Counter()
+        self.lefts = Counter()
+        self.fonts = Counter()
+        self.examples = {"diff": {}, "left": {}, "font": {}}
+
+    def add_diff(self, diff, text):
+        self.diffs[diff] += 1
+        self.examples["diff"].setdefault(diff, text)
+
+    def add_left(self, left, text):
+        self.lefts[left] += 1
+        self.examples["left"].setdefault(left, text)
+
+    def add_font(self, css_class, text):
+        self.fonts[css_class] += 1
+        self.examples["font"].setdefault(css_class, text)
+
+    def save(self, path):
+        """ Writes the histograms to the sidecar file of the xml at path."""
+        data = {"digest": self.digest}
+        for name, ctr in (
+            ("diff", self.diffs),
+            ("left", self.lefts),
+            ("font", self.fonts),
+        ):
+            examples = self.examples[name]
+            data[name] = [[k, v, examples[k]] for k, v in ctr.items()]
+        with codecs.open(path + ANALYSIS_SUFFIX, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def load(path):
+        """ Returns the saved analysis of the xml at path,
+        or None if there is none or the xml has changed since."""
+        sidecar = path + ANALYSIS_SUFFIX
+        if not os.path.exists(sidecar):
+            return None
+        with codecs.open(sidecar, encoding="utf-8") as f:
+            data = json.load(f)
+        digest = file_digest(path)
+        if data.get("digest") != digest:
+            return None
+        analysis = Analysis(digest)
+        for k, v, example in data["diff"]:
+            analysis.diffs[k] = v
+            analysis.examples["diff"][k] = example
+        for k, v, example in data["left"]:
+            analysis.lefts[k] = v
+            analysis.examples["left"][k] = example
+        for k, v, example in data["font"]:
+            analysis.fonts[k] = v
+            analysis.examples["font"][k] = example
+        return analysis
+
+    def report(self, diffs=10, lefts=18):
+        """ Prints the most common diffs and lefts and every font."""
+        for k, v in self.diffs.most_common(diffs):
             print(u"diff: {:>4}  count: {:>4}  example: {}".format(
-                k, v, diff_examples[k]
+                k, v, self.examples["diff"][k]
             ))
-        for k in sorted(max_length.keys()):
-            print("{:>4}: {:>4}".format(k, max_length[k]))
-
-        for k, v in left_ctr.most_common(18):
+        for k, v in self.lefts.most_common(lefts):
             print(u"left: {:>4}  count: {:>4}  example: {}".format(
-                k, v, left_examples[k]
+                k, v, self.examples["left"][k]
             ))
-        for k, v in font_ctr.most_common():
+        for k, v in self.fonts.most_common():
             print(u"font {:>8}: {:>7} {}".format(
-                k.css_class, v, font_examples[k.css_class]
+                k, v, self.examples["font"][k]
+            ))
+
+
+class SampledAnalysis(Analysis):
+    """ Analysis of a sample of the pages, scaled up to the whole book.
+    Each count is reported with the margin it may be off by (95%),
+    from how much it varies between the sampled pages."""
+
+    def __init__(self, total_pages):
+        Analysis.__init__(self, None)
+        self.total_pages = total_pages
+        self.page_counts = []
+
+    def add_page(self, page_analysis):
+        """ Adds the analysis of one sampled page."""
+        self.diffs.update(page_analysis.diffs)
+        self.lefts.update(page_analysis.lefts)
+        self.fonts.update(page_analysis.fonts)
+        for name, examples in page_analysis.examples.items():
+            for k, text in examples.items():
+                self.examples[name].setdefault(k, text)
+        self.page_counts.append(
+            (page_analysis.diffs, page_analysis.lefts, page_analysis.fonts)
+        )
+
+    def estimate(self, which, k):
+        """ Returns the estimated count of k in the whole book and its
+        margin of error. which is 0 for diffs, 1 for lefts, 2 for fonts."""
+        n = len(self.page_counts)
+        counts = [page[which][k] for page in self.page_counts]
+        mean = sum(counts) / float(n)
+        if n < 2:
+            return int(round(mean * self.total_pages)), None
+        variance = sum((c - mean) ** 2 for c in counts) / (n - 1)
+        # finite population correction: sampling every page is exact
+        error = self.total_pages * math.sqrt(
+            variance / n * (1 - n / float(self.total_pages))
+        )
+        return int(round(mean * self.total_pages)), int(round(1.96 * error))
+
+    def save(self, path):
+        raise TypeError("only a full analysis is saved")
+
+    def report(self, diffs=10, lefts=18):
+        """ Prints the most common diffs and lefts and every font,
+        with counts estimated for the whole book."""
+        print(u"sampled {} of {} pages, counts are estimates +/- margin".format(
+            len(self.page_counts), self.total_pages
+        ))
+        for which, label, ctr, top in (
+            (0, u"diff", self.diffs, diffs),
+            (1, u"left", self.lefts, lefts),
+        ):
+            for k, _ in ctr.most_common(top):
+                count, error = self.estimate(which, k)
+                print(u"{}: {:>4}  count: {:>6} +/- {:<5} example: {}".format(
+                    label, k, count, u"?" if error is None else error,
+                    self.examples[label][k]
+                ))
+        for k, _ in self.fonts.most_common():
+            count, error = self.estimate(2, k)
+            print(u"font {:>8}: {:>7} +/- {:<5} {}".format(
+                k, count, u"?" if error is None else error, self.examples["font"][k]
             ))
 
 
 class Page(object):
     """ Holds all the lines in a page."""
 
-    def __init__(self, page_node, fonts, top_margin=0, bottom_margin=0, buf=5):
+    def __init__(
+        self, page_node, fonts, top_margin=0, bottom_margin=0, buf=5, columns=True
+    ):
         """
         params:
         page_node: an xml node with the page tag
@@ -318,17 +1453,20 @@ class Page(object):
         top_margin: how many units to ignore lines within
         bottom_margin: how many units less than the page height to ignore lines within
         buf: how many units within which to consider text on the same 'line'
+        columns: whether to look for columns of text
         """
         self.node = page_node
         self.fonts = fonts
         self.top_margin = top_margin
         self.bottom_margin = bottom_margin
         self.buf = buf
+        self.columns = columns
         self.ignore = self.node.getAttribute("ignore") == "true"
 
     def parse(self):
         """ Sets the number, height, and width attributes.
-        Adds the line objects."""
+        Adds the line objects, keyed by column and top, grouping the
+        text nodes of each column into lines separately."""
         self.number = int(self.node.getAttribute("number"))
         self.height = int(self.node.getAttribute("height"))
         self.width = int(self.node.getAttribute("width"))
@@ -336,7 +1474,11 @@ class Page(object):
         bottom_margin = self.bottom_margin
         for footnote in self.node.getElementsByTagName("footnote"):
             bottom_margin = int(footnote.getAttribute("top")) - 1
-        for n in self.node.getElementsByTagName("text"):
+        nodes = self.node.getElementsByTagName("text")
+        self.nodes = len(nodes)
+        self.chapters = 0
+        lines = []
+        for n in nodes:
             line = Line(n, self.fonts)
             if (
                 not line.text.strip()
@@ -344,15 +1486,136 @@ class Page(object):
                 or line.top > bottom_margin
             ):
                 continue
-            found = False
-            for i in range(2 * self.buf):
-                key = line.top - self.buf + i
-                if key in self.lines.keys():
-                    found = True
-                    old_line = self.lines[key]
-                    old_line.add_line(line)
-            if not found:
-                self.lines[line.top] = CompositeLine(line)
+            if line.font.chapter:
+                self.chapters += 1
+            lines.append(line)
+        bounds = column_bounds(lines, self.width) if self.columns else []
+        columns = [[] for _ in range(len(bounds) + 1)]
+        # where the text of each column starts, so indents are measured
+        # from the column rather than the page
+        lefts = [None] * len(columns)
+        for line in lines:
+            column = bisect_right(bounds, line.left) if bounds else 0
+            if lefts[column] is None or line.left < lefts[column]:
+                lefts[column] = line.left
+            columns[column].append(line)
+        # top to bottom, a node more than buf below the top of the
+        # current line starts the next one, whatever order the xml has
+        for column, column_lines in enumerate(columns):
+            column_lines.sort(key=lambda x: x.top)
+            current = None
+            for line in column_lines:
+                if current is None or line.top > current.top + self.buf:
+                    current = CompositeLine(line, column)
+                    self.lines[(column, line.top)] = current
+                else:
+                    current.add_line(line)
+        self.column_shifts = [
+            0 if left is None or lefts[0] is None else left - lefts[0] for left in lefts
+        ]
+
+
+class PageFragment(object):
+    """ The rendered html of one page.
+
+    lead: written before the html only if the previous page
+          ended a sentence
+    html: the lines, with CHAPTER_MARK where chapter numbers go
+    ends: whether the last line ends a sentence, None if no lines
+    chapters: how many chapter headings the page has
+    """
+
+    def __init__(self, number, lead, html, ends, chapters=0):
+        self.number = number
+        self.lead = lead
+        self.html = html
+        self.ends = ends
+        self.chapters = chapters
+
+    def numbered(self, first, chapter_numbers=True):
+        """ The html with its chapter headings numbered from first,
+        or unnumbered if chapter_numbers is false."""
+        pieces = self.html.split(CHAPTER_MARK)
+        if not chapter_numbers:
+            return u"".join(pieces)
+        parts = [pieces[0]]
+        for offset, piece in enumerate(pieces[1:]):
+            parts.append(u" {}{}".format(first + offset, piece))
+        return u"".join(parts)
+
+
+class Profile(object):
+    """ Wall time, node counts and tracemalloc peaks per stage of a run,
+    and per page for the stages that work a page at a time.
+    Without tracemalloc (Python 2) the peaks are left at 0."""
+
+    def __init__(self):
+        # only loaded for --profile
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self.tracemalloc = tracemalloc
+        self.stages = OrderedDict()
+        self.pages = {}
+        if tracemalloc is not None:
+            tracemalloc.start()
+            # before 3.9 clearing the traces is the only way to reset the peak
+            self.reset_peak = getattr(
+                tracemalloc, "reset_peak", tracemalloc.clear_traces
+            )
+
+    @contextmanager
+    def stage(self, name, nodes=0, page=None):
+        """ Times the block as part of the named stage. The yielded run
+        takes the node count and page number if only known inside."""
+        run = StageRun(nodes, page)
+        if self.tracemalloc is not None:
+            self.reset_peak()
+        start = perf_counter()
+        yield run
+        seconds = perf_counter() - start
+        peak = 0
+        if self.tracemalloc is not None:
+            peak = self.tracemalloc.get_traced_memory()[1]
+        for totals, key in ((self.stages, name), (self.pages, run.page)):
+            if key is None:
+                continue
+            total = totals.setdefault(key, [0.0, 0, 0])
+            total[0] += seconds
+            total[1] += run.nodes
+            total[2] = max(total[2], peak)
+
+    def report(self, slowest=10):
+        """ Prints the stages in the order first seen, then the slowest pages."""
+        out = sys.stderr
+        row = u"{:<12} {:>9.3f} {:>9} {:>10.1f}"
+        print(
+            u"{:<12} {:>9} {:>9} {:>10}".format("stage", "seconds", "nodes", "peak MB"),
+            file=out,
+        )
+        for name, (seconds, nodes, peak) in self.stages.items():
+            print(row.format(name, seconds, nodes, peak / 1e6), file=out)
+        pages = sorted(self.pages.items(), key=lambda x: -x[1][0])[:slowest]
+        if pages:
+            print(u"slowest pages", file=out)
+        for number, (seconds, nodes, peak) in pages:
+            name = u"page {}".format(number)
+            print(row.format(name, seconds, nodes, peak / 1e6), file=out)
+
+
+class StageRun(object):
+    def __init__(self, nodes, page):
+        self.nodes = nodes
+        self.page = page
+
+
+class NullProfile(object):
+    """ Stands in for a Profile when not profiling."""
+
+    @contextmanager
+    def stage(self, name, nodes=0, page=None):
+        yield StageRun(nodes, page)
 
 
 class Font(object):
@@ -362,7 +1625,6 @@ class Font(object):
     """
 
     def __init__(self, fontspec):
-        self.fontspec = fontspec
         self.index = fontspec.getAttribute("id")
         self.size_pt = int(fontspec.getAttribute("size"))
         self.size_pct = 100
@@ -380,11 +1642,26 @@ class Font(object):
 
 
 class CompositeLine(object):
-    def __init__(self, line):
+    """ A logical line made of text nodes kept in left-to-right order.
+    The rendered text is cached until another node is added."""
+
+    __slots__ = ("lines", "lefts", "top", "column", "_width", "_text", "_html_text")
+
+    def __init__(self, line, column=0):
         self.lines = [
             line,
         ]
+        self.lefts = [
+            line.left,
+        ]
         self.top = line.top
+        self.column = column
+        self.clear_cache()
+
+    def clear_cache(self):
+        self._width = None
+        self._text = None
+        self._html_text = None
 
     @property
     def left(self):
@@ -392,31 +1669,37 @@ class CompositeLine(object):
 
     @property
     def width(self):
-        return sum([l.width for l in self.lines])
+        if self._width is None:
+            self._width = sum(l.width for l in self.lines)
+        return self._width
 
     @property
     def text(self):
-        text = ""
-        for line in self.lines:
-            text += line.text
-        return text
+        if self._text is None:
+            self._text = u"".join(l.text for l in self.lines)
+        return self._text
 
     @property
     def html_text(self):
-        text = ""
-        last_right = 0
-        for idx, line in enumerate(self.lines):
-            if idx > 0 and last_right + 5 < line.left:
-                text += " "
-            text += line.html_text
-            last_right = line.left + line.width
-        return text
+        if self._html_text is None:
+            parts = []
+            last_right = 0
+            for idx, line in enumerate(self.lines):
+                if idx > 0 and last_right + 5 < line.left:
+                    parts.append(u" ")
+                parts.append(line.html_text)
+                last_right = line.left + line.width
+            self._html_text = u"".join(parts)
+        return self._html_text
 
     def add_line(self, line):
         # Don't bother adding whitespace
         if line.text.strip():
-            self.lines.append(line)
-            self.lines = sorted(self.lines, key=lambda x: x.left)
+            # after any nodes with the same left, as a stable sort would
+            idx = bisect_right(self.lefts, line.left)
+            self.lefts.insert(idx, line.left)
+            self.lines.insert(idx, line)
+            self.clear_cache()
 
     @property
     def ends_sentence(self):
@@ -428,32 +1711,25 @@ class CompositeLine(object):
 
 
 class Line(object):
-    USE_CHAPTER_NUMBERS = True
-    CHAPTER_NUMBER = 0
+    """ One text node. Slotted and holding no reference to the xml node,
+    so a page of lines costs little and does not keep the dom alive."""
+
+    __slots__ = ("top", "left", "width", "font", "text")
 
     def __init__(self, line, fonts):
-        self.line = line
         self.top = int(line.getAttribute("top"))
         self.left = int(line.getAttribute("left"))
         self.width = int(line.getAttribute("width"))
         self.font = fonts[line.getAttribute("font")]
-        self.text = ""
-        for c in line.childNodes:
-            try:
-                self.text += c.toxml()
-            except:
-                print("exception")
-                pass
-        self.text = re.sub(LINK_TAG, "", self.text)
+        parts = []
+        inline_markup(line, parts)
+        self.text = u"".join(parts)
 
     @property
     def html_text(self):
         if self.font.chapter:
-            Line.CHAPTER_NUMBER += 1
-            if Line.USE_CHAPTER_NUMBERS:
-                return u"<h2>{} {}</h2>".format(self.text, Line.CHAPTER_NUMBER)
-            else:
-                return u"<h2>{}</h2>".format(self.text)
+            # the document fills in the number (or nothing) for the mark
+            return u"<h2>{}{}</h2>".format(self.text, CHAPTER_MARK)
         elif self.font.default:
             return self.text
         else:
@@ -468,21 +1744,476 @@ class Line(object):
         return STARTS_WITH_CAP.search(self.text.strip())
 
 
+def mode(values, default):
+    """ Most common of an array of non-negative ints, or default if empty."""
+    import numpy as np
+
+    if not values.size:
+        return default
+    return int(np.bincount(values).argmax())
+
+
+def band(tops, gaps, pages, spacing, buf):
+    """ Returns the top shared (within buf) by the first or last lines of
+    at least half the pages, if they are usually set apart from the next
+    line by more than one and a half line spacings. Otherwise None."""
+    import numpy as np
+
+    if not tops.size:
+        return None
+    candidate = mode(tops, 0)
+    near = np.abs(tops - candidate) <= buf
+    if np.count_nonzero(near) < 0.5 * pages:
+        return None
+    if np.median(gaps[near]) <= spacing + spacing // 2:
+        return None
+    return candidate
+
+
+def column_bounds(lines, width):
+    """ Returns the lefts at which the second and later columns of text
+    on a page begin, or an empty list for a page of one column.
+
+    The horizontal extent of every line is counted into cells of
+    COLUMN_CELL units with a difference array, so finding the gaps
+    takes one pass over the lines and one over the cells. A gutter is
+    a run of cells crossed by hardly any line (a title over both
+    columns is allowed), at least a fiftieth of the page wide, with a
+    fifth of the page width and an eighth of the lines on each side.
+    A narrow run of text like the page numbers of a table of contents
+    is therefore not a column.
+    """
+    if len(lines) < 2 * MIN_COLUMN_NODES or width <= 0:
+        return []
+    cells = width // COLUMN_CELL + 1
+    cover = [0] * (cells + 1)
+    starts = [0] * cells
+    for line in lines:
+        first = min(max(line.left, 0) // COLUMN_CELL, cells - 1)
+        last = min(max(line.left + line.width, 0) // COLUMN_CELL, cells - 1)
+        cover[first] += 1
+        cover[max(first, last) + 1] -= 1
+        starts[first] += 1
+    crossing = len(lines) // 20
+    # (first cell, end cell, lines starting before it, lines starting
+    # before its end) of each run of empty enough cells between text
+    gaps = []
+    text_start = None
+    text_end = 0
+    gap = None
+    covered = 0
+    started = 0
+    for cell in range(cells):
+        covered += cover[cell]
+        if covered > crossing:
+            if text_start is None:
+                text_start = cell
+            elif gap is not None:
+                gaps.append((gap[0], cell, gap[1], started))
+            gap = None
+            text_end = cell + 1
+        elif gap is None and text_start is not None:
+            gap = (cell, started)
+        started += starts[cell]
+    least_gutter = max(width // 50 // COLUMN_CELL, 2)
+    least_width = width // 5 // COLUMN_CELL
+    least_lines = max(MIN_COLUMN_NODES, len(lines) // 8)
+    bounds = []
+    column_start = text_start
+    column_lines = 0
+    for first, end, before, after in gaps:
+        if (
+            end - first >= least_gutter
+            and first - column_start >= least_width
+            and text_end - end >= least_width
+            and before - column_lines >= least_lines
+            and len(lines) - after >= least_lines
+        ):
+            bounds.append((first + end) // 2 * COLUMN_CELL)
+            column_start = end
+            column_lines = after
+    return bounds
+
+
+def escape_xml(data):
+    """ Escapes text the way minidom's toxml does."""
+    return (
+        data.replace(u"&", u"&amp;")
+        .replace(u"<", u"&lt;")
+        .replace(u'"', u"&quot;")
+        .replace(u">", u"&gt;")
+    )
+
+
+def inline_markup(node, parts):
+    """ Appends the children of node to parts serialized as toxml would,
+    leaving out <a> tags but keeping what is inside them."""
+    for c in node.childNodes:
+        if c.nodeType == c.TEXT_NODE:
+            parts.append(escape_xml(c.data))
+        elif c.nodeType == c.ELEMENT_NODE:
+            if c.tagName == "a":
+                inline_markup(c, parts)
+                continue
+            parts.append(u"<" + c.tagName)
+            for name, value in c.attributes.items():
+                parts.append(u' {}="{}"'.format(name, escape_xml(value)))
+            if c.childNodes:
+                parts.append(u">")
+                inline_markup(c, parts)
+                parts.append(u"</{}>".format(c.tagName))
+            else:
+                parts.append(u"/>")
+        else:
+            parts.append(LINK_TAG.sub(u"", c.toxml()))
+
+
+def buffered(chunks, size=WRITE_BUFFER):
+    """ Encodes text chunks as utf-8 and yields them joined into
+    blocks of at least size bytes, so output takes few writes."""
+    block = []
+    length = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        block.append(data)
+        length += len(data)
+        if length >= size:
+            yield b"".join(block)
+            block = []
+            length = 0
+    if block:
+        yield b"".join(block)
+
+
+def page_chunks(path):
+    """ Yields the raw bytes of each page element of the xml at path.
+    Expects <page> and </page> to start their own lines, as pdftohtml
+    writes them."""
+    chunk = None
+    with open(path, "rb") as f:
+        for line in f:
+            if chunk is None:
+                if line.lstrip().startswith(b"<page"):
+                    chunk = [line]
+            else:
+                chunk.append(line)
+            if chunk is not None and b"</page>" in line:
+                yield b"".join(chunk)
+                chunk = None
+
+
+def page_index(path):
+    """ Scans the xml at path as bytes, without parsing it.
+    Returns an element with the config, title, author and fontspec
+    nodes, and the (start, end) byte offsets of each page element.
+    Like page_chunks, expects pdftohtml's one tag per line layout."""
+    head = []
+    offsets = []
+    offset = 0
+    start = None
+    with open(path, "rb") as f:
+        for line in f:
+            stripped = line.lstrip()
+            if start is None:
+                if stripped.startswith(b"<page"):
+                    start = offset
+                elif stripped.startswith(HEAD_PREFIXES):
+                    head.append(line)
+            elif stripped.startswith(b"<fontspec"):
+                head.append(line)
+            offset += len(line)
+            if start is not None and b"</page>" in line:
+                offsets.append((start, offset))
+                start = None
+    return parseString(b"<head>" + b"".join(head) + b"</head>").documentElement, offsets
+
+
+def page_events(source):
+    """ pulldom events of the xml at source, a path or file. The DTD
+    pdftohtml names is not read, as Python 2 would by default."""
+    parser = make_parser()
+    parser.setFeature(feature_external_ges, False)
+    return pulldom.parse(source, parser=parser)
+
+
+def file_digest(path):
+    """ Hex sha1 of the content of the file at path."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def text_value(parent, child_tag):
     """ Returns text value of first child tag of parent."""
     for n in parent.getElementsByTagName(child_tag):
         return n.firstChild.nodeValue
 
 
-def analyze(path):
-    doc = PDFDoc(path)
-    doc.analyze()
-
+WORKER_SETTINGS = None
+
+
+def init_worker(fonts, top_margin, bottom_margin, buf, columns):
+    """ Stores the document-wide page settings in a pool worker."""
+    global WORKER_SETTINGS
+    WORKER_SETTINGS = (fonts, top_margin, bottom_margin, buf, columns)
+
+
+def parse_page(page_xml):
+    """ Parses the xml of one page in a pool worker.
+    Returns None for an ignored page."""
+    node = parseString(page_xml).documentElement
+    p = Page(node, *WORKER_SETTINGS)
+    if p.ignore:
+        return None
+    p.parse()
+    p.node = None
+    return p
+
+
+def analyze(
+    path,
+    stream=False,
+    diffs=10,
+    lefts=18,
+    refresh=False,
+    profile=None,
+    config=None,
+    sample=0,
+    seed=0,
+):
+    """ Prints the analysis of the xml, reusing the saved one when the
+    xml has not changed so the document does not have to be read.
+    A sampled analysis is only an estimate, so it is never saved."""
+    analysis = None if refresh else Analysis.load(path)
+    if analysis is None:
+        doc = PDFDoc(
+            path, stream, profile=profile, config=config, sample=sample, seed=seed
+        )
+        analysis = doc.analyze()
+        if not sample:
+            analysis.save(path)
+    analysis.report(diffs, lefts)
+
+
+def infer(path):
+    """ Works out the config from the layout and writes it into the xml,
+    replacing any config already there. The settings that are chosen
+    by hand rather than measured, chapter_numbers and columns, are kept."""
+    doc = PDFDoc(path, stream=True)
+    config = doc.infer_config()
+    if not doc.chapter_numbers:
+        config["chapter_numbers"] = "false"
+    if not doc.columns:
+        config["columns"] = "false"
+    element = u"<config {} />".format(
+        u" ".join(
+            u'{}="{}"'.format(k, config[k])
+            for k in CONFIG_ATTRIBUTES
+            if k in config
+        )
+    )
+    print(element)
+    write_config(path, element)
+
+
+@contextmanager
+def output_file(path):
+    """ Yields a temp path next to path, which is moved over path if
+    the block finishes and removed if it raises, so a failed write
+    leaves no partial output that would pass for up to date."""
+    tmp_path = path + ".tmp"
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    replace_file(tmp_path, path)
+
+
+def write_config(path, element):
+    """ Puts the config element in place of the old one, or right after
+    the root tag, by copying the xml to a temp file and renaming it."""
+    tmp_path = path + ".tmp"
+    written = False
+    with open(path, "rb") as src, open(tmp_path, "wb") as dest:
+        for line in src:
+            stripped = line.lstrip()
+            if stripped.startswith(b"<config"):
+                if not written:
+                    dest.write(element.encode("utf-8") + b"\n")
+                    written = True
+                continue
+            dest.write(line)
+            if not written and stripped.startswith(b"<pdf2xml"):
+                dest.write(element.encode("utf-8") + b"\n")
+                written = True
+    replace_file(tmp_path, path)
+
+
+def write_epub(path, jobs=1, output=None, profile=None, config=None):
+    """ Always streams, as --incremental does, so that the book is
+    never held in memory."""
+    doc = PDFDoc(path, True, jobs, profile, config)
+    doc.write_epub(output)
+
+
+def write_chapters(
+    path, stream=False, jobs=1, incremental=False, output=None, profile=None, config=None
+):
+    doc = PDFDoc(path, stream or incremental, jobs, profile, config)
+    if not doc.stream:
+        doc.parse()
+    doc.write_chapters(incremental, output)
+
+
+def write_html(
+    path,
+    stream=False,
+    jobs=1,
+    incremental=False,
+    output=None,
+    compress=False,
+    profile=None,
+    config=None,
+):
+    doc = PDFDoc(path, stream or incremental, jobs, profile, config)
+    if not doc.stream:
+        doc.parse()
+    doc.write_html(incremental, output, compress)
+
+
+def read_config_file(path):
+    """ Returns an element holding the config, title and author elements
+    in the file at path, written as they would be in the xml.
+    With no path the element is empty."""
+    if path is None:
+        return Document().createElement("head")
+    with open(path, "rb") as f:
+        return parseString(b"<head>" + f.read() + b"</head>").documentElement
+
+
+def book_paths(source):
+    """ The xml files to batch: every .xml file in source if it is a
+    directory, otherwise the paths listed one per line in the source
+    manifest (relative to it), skipping blank lines and # comments."""
+    if os.path.isdir(source):
+        return [
+            os.path.join(source, name)
+            for name in sorted(os.listdir(source))
+            if name.endswith(".xml")
+        ]
+    base = os.path.dirname(source)
+    paths = []
+    with open(source) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                paths.append(os.path.join(base, line))
+    return paths
+
+
+def html_name(title):
+    """ The name of the html file for a book with title."""
+    return u"{}.html".format(title.lower().replace(u" ", u"_"))
+
+
+def is_newer(output, path):
+    """ Whether output exists and was modified after path."""
+    if not os.path.exists(output):
+        return False
+    return os.path.getmtime(output) > os.path.getmtime(path)
+
+
+def book_output(path, action, out_dir, form, compress):
+    """ Where a batch puts the analysis or output of the xml at path,
+    named after the xml file, and the file whose time says whether it
+    is up to date: (output, newest)."""
+    if action == "a":
+        output = path + ANALYSIS_SUFFIX
+        return output, output
+    stem = os.path.join(
+        out_dir or os.path.dirname(path), os.path.splitext(os.path.basename(path))[0]
+    )
+    if form == "epub":
+        output = stem + ".epub"
+    elif form == "split":
+        return stem, os.path.join(stem, "index.html")
+    else:
+        output = stem + (".html.gz" if compress else ".html")
+    return output, output
+
+
+def convert_book(task):
+    """ Analyzes or writes one book of a batch in a pool worker.
+    form is "html", "epub" or "split", as --epub and --split choose.
+    Returns (path, status, detail) and never raises."""
+    path, action, out_dir, form, compress = task
+    output, newest = book_output(path, action, out_dir, form, compress)
+    try:
+        if is_newer(newest, path):
+            return path, "skipped", output
+        doc = PDFDoc(path, stream=True)
+        if action == "a":
+            doc.analyze().save(path)
+        elif form == "epub":
+            doc.write_epub(output)
+        elif form == "split":
+            doc.write_chapters(output=output)
+        else:
+            doc.write_html(output=output, compress=compress)
+        return path, "done", output
+    except Exception as e:
+        return path, "failed", u"{}: {}".format(type(e).__name__, e)
+
+
+def batch(source, action="a", jobs=None, out_dir=None, form="html", compress=False):
+    """ Runs analyze ("a") or write on every book of a directory or
+    manifest across a process pool, one book per process at a time.
+    Analyzing only saves each book's analysis; the html (or the epub or
+    split chapters, by form) goes next to each xml unless out_dir is
+    given. A book that would overwrite the output of one before it
+    fails without running. Returns the failed paths."""
+    paths = book_paths(source)
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    failed = []
+    counts = Counter()
+
+    def report(path, status, detail):
+        counts[status] += 1
+        if status == "failed":
+            failed.append(path)
+        print(
+            u"[{}/{}] {} {} {}".format(
+                sum(counts.values()), len(paths), status, path, detail
+            )
+        )
 
-def write_html(path):
-    doc = PDFDoc(path)
-    doc.parse()
-    doc.write_html()
+    tasks = []
+    owners = {}
+    for path in paths:
+        output = book_output(path, action, out_dir, form, compress)[0]
+        key = os.path.normcase(os.path.abspath(output))
+        if key in owners:
+            report(path, "failed", u"same output as {}".format(owners[key]))
+            continue
+        owners[key] = path
+        tasks.append((path, action, out_dir, form, compress))
+    pool = Pool(jobs or cpu_count())
+    try:
+        for result in pool.imap_unordered(convert_book, tasks):
+            report(*result)
+    finally:
+        pool.terminate()
+    print(
+        u"{} done, {} skipped, {} failed".format(
+            counts["done"], counts["skipped"], counts["failed"]
+        )
+    )
+    return failed
 
 
 if __name__ == "__main__":
@@ -492,11 +2223,155 @@ if __name__ == "__main__":
         "-action",
         type=str,
         default="a",
-        help='"a" for analyze, anything else for write',
+        help='"a" for analyze, "infer" to propose a config, anything else for write',
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="read one page at a time instead of loading the whole xml",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="number of processes to parse pages with when writing, "
+        "or to run books with in a batch (default: every core)",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="file_path is a directory of xml files or a manifest of them",
+    )
+    parser.add_argument(
+        "--out-dir", type=str, help="where a batch writes the html"
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        help="file with the config, title and author elements, "
+        "when file_path is a pdf",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only parse and render pages changed since the last write",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help='file to write the html to, "-" for stdout',
+    )
+    parser.add_argument(
+        "--gzip", action="store_true", help="write gzipped html"
+    )
+    parser.add_argument(
+        "--epub",
+        action="store_true",
+        help="write an epub split at the chapter headings instead of html",
+    )
+    parser.add_argument(
+        "--split",
+        action="store_true",
+        help="write one html file per chapter, plus an index, into the "
+        "directory given by --output",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="report time, nodes and memory per stage and for the slowest pages",
+    )
+    parser.add_argument(
+        "--slowest", type=int, default=10, help="pages to list with --profile"
+    )
+    parser.add_argument(
+        "--cprofile", type=str, help="dump cProfile stats to this file"
+    )
+    parser.add_argument(
+        "--diffs", type=int, default=10, help="how many line diffs to show"
+    )
+    parser.add_argument(
+        "--lefts", type=int, default=18, help="how many left margins to show"
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="reanalyze even if the saved analysis matches the xml",
+    )
+    parser.add_argument(
+        "--sample",
+        type=int,
+        default=0,
+        help="analyze only this many pages, spread through the book",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed for --sample"
     )
     args = parser.parse_args()
-
-    if args.action == "a":
-        analyze(args.file_path)
+    if args.incremental and args.file_path.lower().endswith(".pdf"):
+        parser.error("--incremental needs the xml, not the pdf")
+    if args.sample and args.file_path.lower().endswith(".pdf"):
+        parser.error("--sample needs the xml, not the pdf")
+    if args.batch:
+        if args.action == "infer":
+            parser.error("--batch analyzes or writes, it does not infer")
+        for name in ("incremental", "output", "sample"):
+            if getattr(args, name):
+                parser.error("--{} does not work with --batch".format(name))
+
+    profile = Profile() if args.profile else None
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler:
+        profiler.enable()
+    if args.batch:
+        form = "epub" if args.epub else "split" if args.split else "html"
+        if batch(
+            args.file_path, args.action, args.jobs, args.out_dir, form, args.gzip
+        ):
+            sys.exit(1)
+    elif args.action == "infer":
+        infer(args.file_path)
+    elif args.action == "a":
+        analyze(
+            args.file_path,
+            args.stream,
+            args.diffs,
+            args.lefts,
+            args.refresh,
+            profile,
+            args.config,
+            args.sample,
+            args.seed,
+        )
+    elif args.split:
+        write_chapters(
+            args.file_path,
+            args.stream,
+            args.jobs or 1,
+            args.incremental,
+            args.output,
+            profile,
+            args.config,
+        )
+    elif args.epub:
+        write_epub(
+            args.file_path,
+            args.jobs or 1,
+            args.output,
+            profile,
+            args.config,
+        )
     else:
-        write_html(args.file_path)
+        write_html(
+            args.file_path,
+            args.stream,
+            args.jobs or 1,
+            args.incremental,
+            args.output,
+            args.gzip,
+            profile,
+            args.config,
+        )
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+    if profile:
+        profile.report(args.slowest)
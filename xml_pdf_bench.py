@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for xml_pdf
+
+Generates synthetic pdftohtml -xml output and times the analyze, parse
+and write stages of xml_pdf on it, with the tracemalloc peak of each.
+
+Make a test book:
+xml_pdf_bench.py generate book.xml -pages 300 -lines 45
+
+Run the benchmarks and save the results as the baseline:
+xml_pdf_bench.py run --save
+
+Run them again after a change to compare against the baseline:
+xml_pdf_bench.py run
+
+Each stage is timed --repeat times (default 5) and the fastest run is
+kept, as timeit does, since the slower runs only measure whatever else
+the machine was doing. A stage that is more than --tolerance (default
+25%) slower or bigger than the baseline is reported as a regression and
+the exit status is 1. The baseline records its repeat count, and a run
+with a different one says so, as fewer repeats give noisier times.
+The generated books are kept in --work-dir so later runs reuse them.
+"""
+from argparse import ArgumentParser
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import xml_pdf
+
+WORDS = (
+    "the",
+    "quick",
+    "brown",
+    "fox",
+    "jumps",
+    "over",
+    "lazy",
+    "dog",
+    "and",
+    "said",
+    "Mr.",
+    "Smith",
+    "it's",
+    '"then"',
+    "A&B",
+    "<ok>",
+    "whether",
+    "letter",
+    "morning",
+    "house",
+)
+PAGE_HEIGHT = 1188
+PAGE_WIDTH = 918
+HEADER_TOP = 30
+FOOTER_TOP = 1140
+BODY_TOP = 80
+BODY_BOTTOM = 1060
+STAGES = ("analyze", "parse", "write")
+
+
+def escape(text):
+    return (
+        text.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace(">", "&gt;")
+        .replace('"', "&quot;")
+    )
+
+
+def sentence(rng, low=3, high=12):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(low, high))]
+    if rng.random() < 0.3:
+        words[0] = words[0].capitalize()
+        words[-1] += "."
+    return " ".join(words)
+
+
+def generate(
+    path,
+    pages=100,
+    lines=40,
+    fonts=4,
+    split=0.15,
+    headers=True,
+    footers=True,
+    footnotes=0.25,
+    chapter_every=20,
+    seed=1,
+):
+    """ Writes pdftohtml-style xml to path.
+
+    params:
+    pages: number of pages
+    lines: body lines per page
+    fonts: number of fontspecs (at least 3: margins, body, chapter)
+    split: share of lines broken into several text nodes with
+           slightly different tops
+    headers, footers: put a running header or page number on each page
+    footnotes: share of pages with footnotes below a footnote tag
+    chapter_every: pages per chapter heading
+    seed: random seed, so the same arguments give the same file
+    """
+    rng = random.Random(seed)
+    fonts = max(fonts, 3)
+    spacing = max((BODY_BOTTOM - BODY_TOP) // (lines + lines // 8 + 1), 4)
+    buf = max(spacing // 7, 1)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<!DOCTYPE pdf2xml SYSTEM "pdf2xml.dtd">\n')
+        f.write('<pdf2xml producer="poppler" version="0.86.1">\n')
+        f.write(
+            '<config top_margin="{}" bottom_margin="{}" para_break="{}" '
+            'buf="{}" default_font="1" chapter_font="2" />\n'.format(
+                HEADER_TOP + 10, FOOTER_TOP - 10, spacing + spacing // 2, buf
+            )
+        )
+        f.write("<title>Benchmark Book</title>\n")
+        f.write("<author>A. Writer</author>\n")
+        for number in range(1, pages + 1):
+            f.write(
+                '<page number="{}" position="absolute" top="0" left="0" '
+                'height="{}" width="{}">\n'.format(number, PAGE_HEIGHT, PAGE_WIDTH)
+            )
+            if number == 1:
+                sizes = [10, 16, 24] + [12 + i for i in range(fonts - 3)]
+                for idx, size in enumerate(sizes):
+                    f.write(
+                        '\t<fontspec id="{}" size="{}" family="Times" '
+                        'color="#000000"/>\n'.format(idx, size)
+                    )
+            if headers:
+                f.write(
+                    '<text top="{}" left="400" width="120" height="12" '
+                    'font="0">Benchmark Book</text>\n'.format(HEADER_TOP)
+                )
+            top = BODY_TOP
+            if chapter_every and number % chapter_every == 1:
+                f.write(
+                    '<text top="{}" left="300" width="200" height="30" '
+                    'font="2">Chapter <b>{}</b></text>\n'.format(
+                        top, number // chapter_every + 1
+                    )
+                )
+                top += 3 * spacing
+            footnote_top = None
+            if rng.random() < footnotes:
+                footnote_top = BODY_BOTTOM - 3 * spacing
+                f.write('<footnote top="{}"/>\n'.format(footnote_top))
+            for _ in range(lines):
+                if top > BODY_BOTTOM:
+                    break
+                left = 80 if rng.random() < 0.15 else 50
+                font = 0 if footnote_top and top >= footnote_top else 1
+                if rng.random() < split:
+                    first = sentence(rng, 2, 5)
+                    f.write(
+                        '<text top="{}" left="{}" width="180" height="17" '
+                        'font="{}">{}</text>\n'.format(top, left, font, escape(first))
+                    )
+                    odd = rng.randrange(3, fonts) if fonts > 3 else 1
+                    f.write(
+                        '<text top="{}" left="{}" width="70" height="17" '
+                        'font="{}"><i>{}</i></text>\n'.format(
+                            top + rng.randint(-buf, buf),
+                            left + 185,
+                            odd,
+                            escape(rng.choice(WORDS)),
+                        )
+                    )
+                    f.write(
+                        '<text top="{}" left="{}" width="200" height="17" '
+                        'font="{}">{}</text>\n'.format(
+                            top + rng.randint(0, buf),
+                            left + 260,
+                            font,
+                            escape(sentence(rng, 2, 5)),
+                        )
+                    )
+                elif rng.random() < 0.05:
+                    f.write(
+                        '<text top="{}" left="{}" width="400" height="17" '
+                        'font="{}"><a href="book.html#{}">{}</a> and <b>{}</b>'
+                        "</text>\n".format(
+                            top,
+                            left,
+                            font,
+                            number,
+                            escape(sentence(rng)),
+                            escape(rng.choice(WORDS)),
+                        )
+                    )
+                else:
+                    f.write(
+                        '<text top="{}" left="{}" width="450" height="17" '
+                        'font="{}">{}</text>\n'.format(
+                            top, left, font, escape(sentence(rng))
+                        )
+                    )
+                top += spacing * 2 if rng.random() < 0.1 else spacing
+            if footers:
+                f.write(
+                    '<text top="{}" left="450" width="20" height="12" '
+                    'font="0">{}</text>\n'.format(FOOTER_TOP, number)
+                )
+            f.write("</page>\n")
+        f.write("</pdf2xml>\n")
+
+
+def measure(stage, memory):
+    """ Runs stage and returns seconds taken, or the tracemalloc peak in
+    bytes if memory is true, along with what the stage returned."""
+    if memory:
+        tracemalloc.start()
+        result = stage()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak, result
+    start = time.perf_counter()
+    result = stage()
+    return time.perf_counter() - start, result
+
+
+def run_stages(path, output, stream, memory):
+    """ Measures each stage of xml_pdf on the book at path.
+    Parse includes reading the document; write uses the parsed pages."""
+    results = {}
+    results["analyze"], _ = measure(
+        lambda: xml_pdf.PDFDoc(path, stream).analyze(), memory
+    )
+
+    def parse():
+        doc = xml_pdf.PDFDoc(path, stream)
+        doc.parse()
+        return doc
+
+    results["parse"], doc = measure(parse, memory)
+    results["write"], _ = measure(lambda: doc.write_html(output=output), memory)
+    return results
+
+
+def best_times(path, output, stream, repeat):
+    """ The fastest of repeat timings of each stage."""
+    runs = [run_stages(path, output, stream, False) for _ in range(repeat)]
+    return dict((stage, min(times[stage] for times in runs)) for stage in STAGES)
+
+
+def run(sizes, lines, work_dir, stream, memory, repeat=5):
+    """ Returns {pages: {stage: {"seconds": x, "peak_bytes": y}}}, with
+    the best seconds of repeat runs."""
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    report = {}
+    for pages in sizes:
+        path = os.path.join(work_dir, "bench_{}_{}.xml".format(pages, lines))
+        if not os.path.exists(path):
+            print("generating", path, file=sys.stderr)
+            generate(path, pages, lines)
+        output = os.path.join(work_dir, "bench.html")
+        times = best_times(path, output, stream, repeat)
+        peaks = run_stages(path, output, stream, True) if memory else {}
+        report[str(pages)] = dict(
+            (
+                stage,
+                {"seconds": round(times[stage], 4), "peak_bytes": peaks.get(stage)},
+            )
+            for stage in STAGES
+        )
+        for stage in STAGES:
+            print(
+                "{:>6} pages {:>8}: {:>9.3f}s {:>10}".format(
+                    pages,
+                    stage,
+                    times[stage],
+                    "" if not memory else "{:.1f}MB".format(peaks[stage] / 1e6),
+                )
+            )
+    return report
+
+
+def regressions(report, baseline, tolerance):
+    """ Lists the stages that got slower or bigger than the baseline
+    by more than tolerance (a fraction)."""
+    found = []
+    for pages, stages in report.items():
+        for stage, result in stages.items():
+            old = baseline.get(pages, {}).get(stage)
+            if not old:
+                continue
+            for measure_name in ("seconds", "peak_bytes"):
+                new_value = result.get(measure_name)
+                old_value = old.get(measure_name)
+                if new_value and old_value and new_value > old_value * (1 + tolerance):
+                    found.append(
+                        "{} pages {} {}: {} -> {}".format(
+                            pages, stage, measure_name, old_value, new_value
+                        )
+                    )
+    return found
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark xml_pdf")
+    parser.add_argument("action", help='"generate" or "run"')
+    parser.add_argument("file_path", nargs="?", help="xml to generate")
+    parser.add_argument("-pages", type=int, default=100)
+    parser.add_argument("-lines", type=int, default=40)
+    parser.add_argument("-fonts", type=int, default=4)
+    parser.add_argument("-split", type=float, default=0.15)
+    parser.add_argument("-footnotes", type=float, default=0.25)
+    parser.add_argument("-seed", type=int, default=1)
+    parser.add_argument("--no-headers", action="store_true")
+    parser.add_argument("--no-footers", action="store_true")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 10000]
+    )
+    parser.add_argument("--work-dir", type=str, default="bench_books")
+    parser.add_argument("--baseline", type=str, default="xml_pdf_bench.json")
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="timings per stage, the best is kept"
+    )
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip the tracemalloc runs"
+    )
+    args = parser.parse_args()
+
+    if args.action == "generate":
+        generate(
+            args.file_path,
+            args.pages,
+            args.lines,
+            args.fonts,
+            args.split,
+            not args.no_headers,
+            not args.no_footers,
+            args.footnotes,
+            seed=args.seed,
+        )
+    elif args.action == "run":
+        report = run(
+            args.sizes,
+            args.lines,
+            args.work_dir,
+            args.stream,
+            not args.no_memory,
+            args.repeat,
+        )
+        if args.save:
+            with open(args.baseline, "w") as f:
+                json.dump(
+                    {"repeat": args.repeat, "pages": report}, f, indent=2, sort_keys=True
+                )
+        elif os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if baseline.get("repeat") != args.repeat:
+                print(
+                    "baseline timed with --repeat {}, this run with {}".format(
+                        baseline.get("repeat"), args.repeat
+                    )
+                )
+            found = regressions(report, baseline.get("pages", {}), args.tolerance)
+            for line in found:
+                print("REGRESSION", line)
+            if found:
+                sys.exit(1)
+    else:
+        print("WRONG")